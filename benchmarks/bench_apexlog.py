@@ -0,0 +1,98 @@
+""" Measures parsing of large Apex debug logs
+    Compares regular expression passes over the whole log text with sfdclib.logparser
+    Usage (from repository root): python -m benchmarks.bench_apexlog [megabytes] """
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sfdclib.logparser import SfdcApexLogParser
+
+
+def compose_log(path, megabytes):
+    """ Writes synthetic log of about the given size with nested code units, queries, DML and debug output """
+    size = megabytes * 1024 * 1024
+    nanos = 0
+    i = 0
+    with open(path, 'w') as file:
+        file.write('52.0 APEX_CODE,FINEST;APEX_PROFILING,INFO;DB,INFO\n')
+        while file.tell() < size:
+            lines = [
+                ('CODE_UNIT_STARTED', '[EXTERNAL]|01p000000000001|Handler%d.run()' % i),
+                ('STATEMENT_EXECUTE', '[12]'),
+                ('SOQL_EXECUTE_BEGIN', '[14]|Aggregations:0|SELECT Id, Name FROM Account WHERE Id = :recordId'),
+                ('SOQL_EXECUTE_END', '[14]|Rows:%d' % (i % 7)),
+                ('VARIABLE_ASSIGNMENT', '[15]|accounts|"List of size 3"|0x1a2b3c'),
+                ('DML_BEGIN', '[20]|Op:Update|Type:Account|Rows:%d' % (i % 5)),
+                ('DML_END', '[20]'),
+                ('USER_DEBUG', '[22]|DEBUG|processed batch %d\nsecond line of message' % i),
+                ('LIMIT_USAGE', '[23]|SOQL|%d|100' % (i % 100)),
+                ('CODE_UNIT_FINISHED', 'Handler%d.run()' % i),
+            ]
+            for name, fields in lines:
+                nanos += 1500
+                file.write('12:00:%02d.%03d (%d)|%s|%s\n' % (
+                    nanos // 1000000000 % 60, nanos // 1000000 % 1000, nanos, name, fields))
+            i += 1
+        file.write('12:00:59.999 (%d)|LIMIT_USAGE_FOR_NS|(default)|\n'
+                   '  Number of SOQL queries: 100 out of 100\n'
+                   '  Number of DML statements: 50 out of 150\n' % (nanos + 1))
+
+
+def count_with_regex(path):
+    """ Previous approach: whole log loaded as text and scanned by separate regular expression passes """
+    with open(path) as file:
+        text = file.read()
+    soql = re.findall(r'\|SOQL_EXECUTE_BEGIN\|', text)
+    rows = sum(int(value) for value in re.findall(r'\|SOQL_EXECUTE_END\|\[\d+\]\|Rows:(\d+)', text))
+    dml = re.findall(r'\|DML_BEGIN\|', text)
+    dml_rows = sum(int(value) for value in re.findall(r'\|DML_BEGIN\|\[\d+\]\|Op:\w+\|Type:\w+\|Rows:(\d+)', text))
+    debug = re.findall(r'\|USER_DEBUG\|\[\d+\]\|\w+\|(.*)', text)
+    return len(soql), rows, len(dml), dml_rows, len(debug)
+
+
+def measure(name, func):
+    """ Runs func once for timing and once more under tracemalloc for peak memory """
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("%-28s %8.2f s %10.1f MB peak" % (name, elapsed, peak / 1024.0 / 1024.0))
+    return result
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    handle, path = tempfile.mkstemp(suffix='.log')
+    os.close(handle)
+    try:
+        compose_log(path, megabytes)
+        print("Log of %.1f MB" % (os.path.getsize(path) / 1024.0 / 1024.0))
+
+        parser = SfdcApexLogParser()
+        counts = measure('regex passes', lambda: count_with_regex(path))
+        index = measure('build_index', lambda: parser.build_index(path))
+        measure('iter_events (SOQL only)',
+                lambda: sum(1 for _ in SfdcApexLogParser(['SOQL_EXECUTE']).iter_events(path)))
+
+        aggregates = index.get_aggregates()
+        assert counts[:4] == (aggregates['soql_count'], aggregates['soql_rows'],
+                              aggregates['dml_count'], aggregates['dml_rows'])
+        offsets = index.get_offsets('DML')
+        sample = offsets[::max(1, len(offsets) // 1000)]
+        start = time.perf_counter()
+        for offset in sample:
+            parser.read_event(path, 'DML', offset)
+        print("%-28s %8.4f s per event" % ('read_event (DML)', (time.perf_counter() - start) / len(sample)))
+        print("SOQL %(soql_count)d rows %(soql_rows)d, DML %(dml_count)d rows %(dml_rows)d" % aggregates)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
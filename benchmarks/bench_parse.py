@@ -0,0 +1,108 @@
+""" Measures cost of parsing large checkDeployStatus responses
+    Compares namespaced find() lookups used previously with sfdclib.parsers. Building the element tree
+    dominates both, so totals are about the same; only polling without details makes parsing cheaper
+    Usage (from repository root): python -m benchmarks.bench_parse [components] [tests] """
+import sys
+import timeit
+from xml.etree import ElementTree as ET
+
+from sfdclib.parsers import DeployResult, parse_deploy_result
+
+NAMESPACES = {
+    'soapenv': 'http://schemas.xmlsoap.org/soap/envelope/',
+    'mt': 'http://soap.sforce.com/2006/04/metadata'
+}
+
+
+def compose_response(components, tests, include_details=True):
+    """ Composes deploy result with component successes, test successes and a few failures """
+    parts = [
+        '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+        'xmlns="http://soap.sforce.com/2006/04/metadata"><soapenv:Body>'
+        '<checkDeployStatusResponse><result><id>0Af000000000001</id><status>Failed</status>'
+        '<numberComponentsTotal>%d</numberComponentsTotal><numberComponentErrors>10</numberComponentErrors>'
+        '<numberComponentsDeployed>%d</numberComponentsDeployed><numberTestsTotal>%d</numberTestsTotal>'
+        '<numberTestErrors>10</numberTestErrors><numberTestsCompleted>%d</numberTestsCompleted><details>'
+        % (components, components, tests, tests)]
+    if not include_details:
+        parts[0] = parts[0].replace('<details>', '')
+        parts.append('</result></checkDeployStatusResponse></soapenv:Body></soapenv:Envelope>')
+        return ''.join(parts).encode('utf-8')
+    for i in range(components):
+        parts.append(
+            '<componentSuccesses><changed>true</changed><componentType>ApexClass</componentType>'
+            '<fileName>classes/Class%d.cls</fileName><fullName>Class%d</fullName></componentSuccesses>' % (i, i))
+    for i in range(10):
+        parts.append(
+            '<componentFailures><componentType>ApexClass</componentType><fileName>classes/Bad%d.cls</fileName>'
+            '<problem>Unexpected token</problem><problemType>Error</problemType></componentFailures>' % i)
+    parts.append('<runTestResult>')
+    for i in range(tests):
+        parts.append(
+            '<successes><name>Class%dTest</name><methodName>testMethod</methodName>'
+            '<time>12.0</time></successes>' % i)
+    for i in range(10):
+        parts.append(
+            '<failures><name>Bad%dTest</name><methodName>testMethod</methodName>'
+            '<message>Assertion failed</message><stackTrace>Class.Bad%dTest: line 1</stackTrace></failures>' % (i, i))
+    parts.append('</runTestResult></details></result></checkDeployStatusResponse></soapenv:Body></soapenv:Envelope>')
+    return ''.join(parts).encode('utf-8')
+
+
+def parse_with_find(text):
+    """ Parses response the way it was done before introducing sfdclib.parsers """
+    return extract_with_find(ET.fromstring(text))
+
+
+def extract_with_find(root):
+    """ Extracts deploy status from parsed response using namespaced find() paths """
+    result = root.find('soapenv:Body/mt:checkDeployStatusResponse/mt:result', NAMESPACES)
+    status = {
+        'state': result.find('mt:status', NAMESPACES).text,
+        'total_count': result.find('mt:numberComponentsTotal', NAMESPACES).text,
+        'failed_count': result.find('mt:numberComponentErrors', NAMESPACES).text,
+        'deployed_count': result.find('mt:numberComponentsDeployed', NAMESPACES).text,
+        'tests_total': result.find('mt:numberTestsTotal', NAMESPACES).text,
+        'tests_failed': result.find('mt:numberTestErrors', NAMESPACES).text,
+        'tests_completed': result.find('mt:numberTestsCompleted', NAMESPACES).text,
+        'errors': [],
+        'test_errors': []
+    }
+    for failure in result.findall('mt:details/mt:componentFailures', NAMESPACES):
+        status['errors'].append({
+            'type': failure.find('mt:componentType', NAMESPACES).text,
+            'file': failure.find('mt:fileName', NAMESPACES).text,
+            'status': failure.find('mt:problemType', NAMESPACES).text,
+            'message': failure.find('mt:problem', NAMESPACES).text
+        })
+    for failure in result.findall('mt:details/mt:runTestResult/mt:failures', NAMESPACES):
+        status['test_errors'].append({
+            'class': failure.find('mt:name', NAMESPACES).text,
+            'method': failure.find('mt:methodName', NAMESPACES).text,
+            'message': failure.find('mt:message', NAMESPACES).text,
+            'stack_trace': failure.find('mt:stackTrace', NAMESPACES).text
+        })
+    return status
+
+
+def main():
+    components = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    tests = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    text = compose_response(components, tests)
+    print("Response size: %.1f MB" % (len(text) / 1024.0 / 1024.0))
+
+    summary = compose_response(components, tests, include_details=False)
+    root = ET.fromstring(text)
+    result = root.find('soapenv:Body/mt:checkDeployStatusResponse/mt:result', NAMESPACES)
+    for name, func in [('XML parsing only', lambda: ET.fromstring(text)),
+                       ('find() extraction', lambda: extract_with_find(root)),
+                       ('parsers extraction', lambda: DeployResult.from_element(result).to_status()),
+                       ('find() total', lambda: parse_with_find(text)),
+                       ('parsers total', lambda: parse_deploy_result(text).to_status()),
+                       ('without details', lambda: parse_deploy_result(summary).to_status())]:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print("%-20s %8.2f ms" % (name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,13 +12,17 @@ setup(
     url='https://github.com/rbauction/sfdclib',
     license='MIT',
     description=("SFDClib is a Salesforce.com Metadata API and Tooling "
-                 "API client built for Python 2.7, 3.3 and 3.4."),
+                 "API client built for Python 3.5 and later."),
     long_description=textwrap.dedent(open('README.rst', 'r').read()),
+    python_requires='>=3.5',
     package_data={'': ['LICENSE']},
     package_dir={'sfdclib': 'sfdclib'},
     install_requires=[
         'requests[security]'
     ],
+    extras_require={
+        'async': ['aiohttp']
+    },
     keywords="python salesforce salesforce.com metadata tooling api",
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -27,8 +31,9 @@ setup(
         'Intended Audience :: System Administrators',
         'Operating System :: OS Independent',
         'Topic :: Internet :: WWW/HTTP',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4'
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7'
     ]
 )
@@ -4,6 +4,18 @@ from sfdclib.logger import (
     SfdcLogger
 )
 
+from sfdclib.cache import (
+    SfdcFileQueryCache,
+    SfdcFileTokenCache,
+    SfdcMemoryQueryCache,
+    SfdcMemoryTokenCache,
+    SfdcMetadataCache
+)
+
+from sfdclib.poller import (
+    SfdcPoller
+)
+
 from sfdclib.session import (
     SfdcSession
 )
@@ -12,14 +24,40 @@ from sfdclib.tooling import (
     SfdcToolingApi
 )
 
+from sfdclib.apex import (
+    SfdcApexRunner
+)
+
+from sfdclib.apexlog import (
+    SfdcApexLogHarvester
+)
+
+from sfdclib.logparser import (
+    SfdcApexLogIndex,
+    SfdcApexLogParser
+)
+
 from sfdclib.metadata import (
     SfdcMetadataApi
 )
 
 from sfdclib.bulk import (
-    SfdcBulkApi
+    SfdcBulkApi,
+    SfdcBulkJobMonitor
+)
+
+from sfdclib.bulk2 import (
+    SfdcBulk2Api
 )
 
 from sfdclib.rest import (
     SfdcRestApi
 )
+
+from sfdclib.aio import (
+    AsyncSfdcSession,
+    AsyncSfdcRestApi,
+    AsyncSfdcToolingApi,
+    AsyncSfdcBulkApi,
+    AsyncSfdcMetadataApi
+)
@@ -0,0 +1,908 @@
+""" Asyncio counterparts of session and API classes """
+import asyncio
+import datetime
+import json
+import time
+from collections import deque
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import sfdclib.messages as msg
+from sfdclib.bulk import SfdcBulkApi, SfdcBulkJobMonitor
+from sfdclib.metadata import SfdcMetadataApi, _DeployProgress, _RetrieveResultParser
+from sfdclib.parsers import parse_async_result, parse_deploy_result, parse_retrieve_result
+from sfdclib.poller import SfdcPoller
+from sfdclib.rest import SfdcRestApi
+from sfdclib.session import SfdcSession
+from sfdclib.tooling import SfdcToolingApi
+
+
+async def _poll(poller, func, is_done):
+    """ Awaits func until is_done returns True for its result, returns last result """
+    delays = poller.delays()
+    result = await func()
+    while not is_done(result):
+        delay = next(delays, None)
+        if delay is None:
+            raise poller.get_timeout_error()
+        await asyncio.sleep(delay)
+        result = await func()
+    return result
+
+
+async def _dispatch(func, groups, max_concurrency):
+    """ Awaits func for every group concurrently, returns concatenated results in groups' order
+        At most max_concurrency groups are held in memory and sent at once """
+    results = []
+    pending = []
+    try:
+        for group in groups:
+            if len(pending) >= max_concurrency:
+                results.extend(await pending.pop(0))
+            pending.append(asyncio.ensure_future(func(group)))
+        while pending:
+            results.extend(await pending.pop(0))
+    except Exception:
+        for task in pending:
+            task.cancel()
+        raise
+    return results
+
+
+class AsyncSfdcResponse:
+    """ Fully read HTTP response """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+
+class AsyncSfdcSession:
+    """ Asyncio counterpart of SfdcSession built on aiohttp
+        Accepts the same arguments as SfdcSession plus limit, maximum number of open connections """
+
+    def __init__(
+            self, username=None, password=None, token=None,
+            is_sandbox=False, api_version=SfdcSession._DEFAULT_API_VERSION,
+            **kwargs):
+        if aiohttp is None:
+            raise Exception("aiohttp package must be installed to use asyncio classes")
+        self._username = username
+        self._password = password
+        self._token = token
+        self._is_sandbox = is_sandbox
+        self._api_version = api_version
+        self._session_id = kwargs.get("session_id", None)
+        self._instance = kwargs.get("instance", None)
+        self._instance_url = kwargs.get("instance_url", None)
+        self._org_id = kwargs.get("org_id", None)
+        self._limit = kwargs.get("limit", 100)
+        self._token_cache = kwargs.get("token_cache", None)
+        self._login_lock = None
+        self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _get_client(self):
+        """ Creates HTTP client on first use so it is bound to the running event loop """
+        if self._client is None:
+            self._client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._limit))
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def _send(self, method, url, **kwargs):
+        async with self._get_client().request(method, url, **kwargs) as res:
+            content = await res.read()
+            return AsyncSfdcResponse(res.status, res.headers, content)
+
+    async def request(self, method, url, **kwargs):
+        """ Sends HTTP request and reads the whole response
+            If session expired logs in again and repeats the request once """
+        session_id = self._session_id
+        res = await self._send(method, url, **kwargs)
+        if session_id is None or not self._can_login() or \
+                not SfdcSession._is_session_expired(res.status_code, res.content):
+            return res
+
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if self._session_id == session_id:
+                await self.login(refresh=True)
+        retry = SfdcSession._replace_session_id(kwargs, session_id, self._session_id)
+        if retry is None:
+            return res
+        return await self._send(method, url, **retry)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request('PATCH', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+    async def login(self, refresh=False):
+        """ Logs in, valid session id found in token cache is reused unless refresh is True """
+        if self._token_cache is not None and not refresh:
+            token = self._token_cache.get(self._get_token_key())
+            if token is not None:
+                self._session_id, self._instance, self._org_id = \
+                    token['session_id'], token['instance'], token['org_id']
+                return
+
+        url = self.construct_url(self.get_soap_api_uri())
+        headers = {'Content-Type': 'text/xml', 'SOAPAction': 'login'}
+        data = SfdcSession._get_login_request(self._username, self._password, self._token)
+        r = await self._send('POST', url, headers=headers, data=data)
+        self._session_id, self._instance, self._org_id = SfdcSession._parse_login_response(r.text)
+
+        if self._token_cache is not None:
+            self._token_cache.set(self._get_token_key(), {
+                'session_id': self._session_id,
+                'instance': self._instance,
+                'org_id': self._org_id,
+                'created': time.time()
+            })
+
+    def _get_token_key(self):
+        return "{0}@{1}".format(
+            self._username, self._instance_url or ('test' if self._is_sandbox else 'login'))
+
+    def _can_login(self):
+        return self._username is not None and self._password is not None
+
+    def get_server_url(self):
+        if self._instance_url:
+            return self._instance_url
+        if not self._instance:
+            return SfdcSession._LOGIN_URL.format(**{'instance': 'test' if self._is_sandbox else 'login'})
+        return SfdcSession._LOGIN_URL.format(**{'instance': self._instance})
+
+    def get_soap_api_uri(self):
+        return SfdcSession._SOAP_API_BASE_URI.format(**{'version': self._api_version})
+
+    def construct_url(self, uri):
+        return "%s%s" % (self.get_server_url(), uri)
+
+    def get_api_version(self):
+        return self._api_version
+
+    def get_session_id(self):
+        return self._session_id
+
+    def get_org_id(self):
+        return self._org_id
+
+    def is_connected(self):
+        return True if self._instance or self._instance_url and self._session_id else False
+
+
+class AsyncSfdcRestApi:
+    """ Asyncio counterpart of SfdcRestApi """
+    _API_BASE_URI = SfdcRestApi._API_BASE_URI
+    _SOQL_QUERY_URI = SfdcRestApi._SOQL_QUERY_URI
+
+    def __init__(self, session):
+        if not session.is_connected():
+            raise Exception("Session must be connected prior to instantiating this class")
+        self._session = session
+
+    def _get_api_uri(self):
+        """ Returns REST API base URI for this connection """
+        return self._API_BASE_URI.format(**{'version': self._session.get_api_version()})
+
+    def _get_headers(self):
+        """ Compose HTTP header for request """
+        return {
+            'Authorization': 'Bearer %s' % self._session.get_session_id(),
+            'Accept-Encoding': 'gzip',
+            'Content-Type': 'application/json'}
+
+    async def get(self, uri):
+        """ HTTP GET request """
+        url = self._session.construct_url(self._get_api_uri() + uri)
+        response = await self._session.get(url, headers=self._get_headers())
+        return SfdcRestApi._parse_get_post_response(response)
+
+    async def post(self, uri, data):
+        """ HTTP POST request """
+        url = self._session.construct_url(self._get_api_uri() + uri)
+        response = await self._session.post(url, headers=self._get_headers(), json=data)
+        return SfdcRestApi._parse_get_post_response(response)
+
+    async def patch(self, uri, data):
+        """ HTTP PATCH request """
+        url = self._session.construct_url(self._get_api_uri() + uri)
+        response = await self._session.patch(url, headers=self._get_headers(), json=data)
+        return SfdcRestApi._parse_get_post_response(response)
+
+    async def delete(self, uri):
+        """ HTTP DELETE request """
+        url = self._session.construct_url(self._get_api_uri() + uri)
+        response = await self._session.delete(url, headers=self._get_headers())
+        if response.status_code != 204:
+            raise Exception("Request failed, status code is not 204: %s" % response.text)
+
+    async def soql_query(self, query):
+        """ SOQL query """
+        res = await self.get(self._SOQL_QUERY_URI.format(**{'query': urlencode({'q': query})}))
+        if not isinstance(res, dict):
+            raise Exception("Request failed. Response: %s" % res)
+        return res
+
+    async def _get_next_records(self, next_records_url):
+        """ Fetches next page of query results """
+        url = self._session.construct_url(next_records_url)
+        res = SfdcRestApi._parse_get_post_response(await self._session.get(url, headers=self._get_headers()))
+        if not isinstance(res, dict):
+            raise Exception("Request failed. Response: %s" % res)
+        return res
+
+    def query_iter(self, query, prefetch=True):
+        """ Returns asynchronous iterator (async for) of records of SOQL query following nextRecordsUrl """
+        return AsyncSfdcQueryIterator(self, SfdcRestApi._SOQL_QUERY_URI, query, prefetch)
+
+    def query_all_iter(self, query, prefetch=True):
+        """ Returns asynchronous iterator of records of SOQL query including deleted and archived ones """
+        return AsyncSfdcQueryIterator(self, SfdcRestApi._SOQL_QUERY_ALL_URI, query, prefetch)
+
+    async def _post_collection(self, method, uri, object_name, records, all_or_none, max_concurrency):
+        """ Sends records to sObject Collections resource in groups of 200 """
+        SfdcRestApi._check_api_version(self._session, "sObject Collections", SfdcRestApi._COLLECTIONS_MIN_VERSION)
+
+        async def send(group):
+            res = await method(uri, {'allOrNone': all_or_none,
+                                     'records': SfdcRestApi._add_attributes(group, object_name)})
+            if not isinstance(res, list):
+                raise Exception("Request failed. Response: %s" % res)
+            return res
+
+        return await _dispatch(send, SfdcRestApi._split_all_or_none(
+            records, SfdcRestApi._MAX_COLLECTION_SIZE, all_or_none), max_concurrency)
+
+    async def create_records(self, object_name, records, all_or_none=False, max_concurrency=4):
+        """ Creates records using sObject Collections, returns per-record results in input order """
+        return await self._post_collection(
+            self.post, SfdcRestApi._SOBJECT_COLLECTIONS_URI, object_name, records, all_or_none, max_concurrency)
+
+    async def update_records(self, object_name, records, all_or_none=False, max_concurrency=4):
+        """ Updates records using sObject Collections
+            Records will be matched by Id field """
+        return await self._post_collection(
+            self.patch, SfdcRestApi._SOBJECT_COLLECTIONS_URI, object_name, records, all_or_none, max_concurrency)
+
+    async def upsert_records(self, object_name, external_id_field, records, all_or_none=False, max_concurrency=4):
+        """ Upserts records using sObject Collections
+            Records will be matched by external id field """
+        uri = "{0}/{1}/{2}".format(SfdcRestApi._SOBJECT_COLLECTIONS_URI, object_name, external_id_field)
+        return await self._post_collection(self.patch, uri, object_name, records, all_or_none, max_concurrency)
+
+    async def delete_records(self, ids, all_or_none=False, max_concurrency=4):
+        """ Deletes records using sObject Collections """
+        SfdcRestApi._check_api_version(self._session, "sObject Collections", SfdcRestApi._COLLECTIONS_MIN_VERSION)
+
+        async def send(group):
+            url = self._session.construct_url(
+                self._get_api_uri() + SfdcRestApi._SOBJECT_COLLECTIONS_URI + "?" +
+                SfdcRestApi._get_delete_query(group, all_or_none))
+            res = SfdcRestApi._parse_get_post_response(await self._session.delete(url, headers=self._get_headers()))
+            if not isinstance(res, list):
+                raise Exception("Request failed. Response: %s" % res)
+            return res
+
+        return await _dispatch(send, SfdcRestApi._split_all_or_none(
+            ids, SfdcRestApi._MAX_COLLECTION_SIZE, all_or_none), max_concurrency)
+
+    async def composite(self, subrequests, all_or_none=False, max_concurrency=4):
+        """ Executes subrequests using Composite resource in groups of 25
+            Groups are independent and run concurrently, so more than 25 subrequests are only accepted
+            if they do not use references (@{...}) and all_or_none is False """
+        subrequests = SfdcRestApi._check_composite(self._session, subrequests)
+
+        async def send(group):
+            res = await self.post(SfdcRestApi._COMPOSITE_URI, {'allOrNone': all_or_none, 'compositeRequest': group})
+            if not isinstance(res, dict):
+                raise Exception("Request failed. Response: %s" % res)
+            return res['compositeResponse']
+
+        return await _dispatch(send, SfdcRestApi._split_all_or_none(
+            subrequests, SfdcRestApi._MAX_COMPOSITE_SIZE, all_or_none), max_concurrency)
+
+    async def composite_batch(self, subrequests, halt_on_error=False, max_concurrency=4):
+        """ Executes independent subrequests using Composite Batch resource in groups of 25
+            halt_on_error only stops remaining subrequests of the same group """
+        async def send(group):
+            res = await self.post(SfdcRestApi._COMPOSITE_BATCH_URI,
+                                  {'haltOnError': halt_on_error, 'batchRequests': group})
+            if not isinstance(res, dict):
+                raise Exception("Request failed. Response: %s" % res)
+            return res['results']
+
+        return await _dispatch(
+            send, SfdcRestApi._split(subrequests, SfdcRestApi._MAX_COMPOSITE_SIZE), max_concurrency)
+
+    async def composite_tree(self, object_name, records, max_concurrency=4):
+        """ Creates record trees using sObject Tree resource in groups of up to 200 records
+            Root records without attributes get type and generated reference Id """
+        async def send(group):
+            res = await self.post(SfdcRestApi._COMPOSITE_TREE_URI.format(**{'object': object_name}),
+                                  {'records': SfdcRestApi._add_tree_attributes(group, object_name)})
+            if not isinstance(res, dict):
+                raise Exception("Request failed. Response: %s" % res)
+            return res['results']
+
+        return await _dispatch(
+            send, SfdcRestApi._split_trees(records, SfdcRestApi._MAX_COLLECTION_SIZE), max_concurrency)
+
+
+class AsyncSfdcQueryIterator:
+    """ Asynchronous iterator of records of all pages of query results
+        If prefetch is True next page is fetched in background while current one is consumed """
+
+    def __init__(self, rest, uri, query, prefetch):
+        self._rest = rest
+        self._uri = uri
+        self._query = query
+        self._prefetch = prefetch
+        self._records = None
+        self._next_records_url = None
+        self._next_page = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._records:
+            if self._records is None:
+                res = await self._rest.get(self._uri.format(**{'query': urlencode({'q': self._query})}))
+                if not isinstance(res, dict):
+                    raise Exception("Request failed. Response: %s" % res)
+            elif self._next_page is not None:
+                res = await self._next_page
+                self._next_page = None
+            elif self._next_records_url:
+                res = await self._rest._get_next_records(self._next_records_url)
+            else:
+                raise StopAsyncIteration
+            self._records = deque(res['records'])
+            self._next_records_url = res.get('nextRecordsUrl')
+            if self._next_records_url and self._prefetch:
+                self._next_page = asyncio.ensure_future(self._rest._get_next_records(self._next_records_url))
+        return self._records.popleft()
+
+    def close(self):
+        """ Cancels fetching of the next page if iteration is abandoned """
+        if self._next_page is not None:
+            self._next_page.cancel()
+            self._next_page = None
+
+
+class AsyncSfdcToolingApi:
+    """ Asyncio counterpart of SfdcToolingApi """
+    _TOOLING_API_BASE_URI = SfdcToolingApi._TOOLING_API_BASE_URI
+    _ANON_QUERY_URI = SfdcToolingApi._ANON_QUERY_URI
+    _EXECUTE_ANON_APEX_URI = SfdcToolingApi._EXECUTE_ANON_APEX_URI
+    _APEX_LOG_URI = SfdcToolingApi._APEX_LOG_URI
+
+    def __init__(self, session):
+        if not session.is_connected():
+            raise Exception("Session must be connected prior to instantiating this class")
+        self._session = session
+
+    def _get_tooling_api_uri(self):
+        """ Returns Tooling API base URI for this connection """
+        return self._TOOLING_API_BASE_URI.format(**{'version': self._session.get_api_version()})
+
+    def _get_headers(self):
+        """ Compose HTTP header for request """
+        return {
+            'Authorization': 'Bearer %s' % self._session.get_session_id(),
+            'Accept-Encoding': 'gzip',
+            'Content-Type': 'application/json'}
+
+    async def get(self, uri):
+        """ HTTP GET request """
+        url = self._session.construct_url(self._get_tooling_api_uri() + uri)
+        response = await self._session.get(url, headers=self._get_headers())
+        return SfdcToolingApi._parse_get_post_response(response)
+
+    async def get_textBody(self, uri):
+        """ HTTP GET request returning response body as text """
+        url = self._session.construct_url(self._get_tooling_api_uri() + uri)
+        response = await self._session.get(url, headers=self._get_headers())
+        return response.text
+
+    async def post(self, uri, data):
+        """ HTTP POST request """
+        url = self._session.construct_url(self._get_tooling_api_uri() + uri)
+        response = await self._session.post(url, headers=self._get_headers(), data=data)
+        return SfdcToolingApi._parse_get_post_response(response)
+
+    async def delete(self, uri):
+        """ HTTP DELETE request """
+        url = self._session.construct_url(self._get_tooling_api_uri() + uri)
+        response = await self._session.delete(url, headers=self._get_headers())
+        if response.status_code != 204:
+            raise Exception("Request failed, status code is not 204: %s" % response.text)
+
+    async def anon_query(self, query):
+        """ Anonymous query """
+        res = await self.get(self._ANON_QUERY_URI.format(**{'query': urlencode({'q': query})}))
+        if not isinstance(res, dict):
+            raise Exception("Request failed. Response: %s" % res)
+        return res
+
+    async def anon_apex(self, apex):
+        """ Anonymous APEX """
+        res = await self.get(self._EXECUTE_ANON_APEX_URI.format(**{'a': urlencode({'anonymousBody': apex})}))
+        if not isinstance(res, dict):
+            raise Exception("Request failed. Response: %s" % res)
+        return res
+
+    async def apexLog_Q(self, id):
+        """ Returns body of Apex log """
+        return await self.get_textBody(self._APEX_LOG_URI.format(**{'uid': id}))
+
+    @staticmethod
+    def _get_first_id(res):
+        records = res.get('records') or []
+        return records[0]['Id'] if records else None
+
+    async def get_sf_user_id(self, username):
+        return self._get_first_id(await self.anon_query("SELECT Id FROM User WHERE Username = '%s'" % username))
+
+    async def get_DevDebugLevelId(self):
+        res = await self.anon_query("select DebugLevelId from TraceFlag WHERE LogType = 'DEVELOPER_LOG' LIMIT 1")
+        records = res.get('records') or []
+        return records[0]['DebugLevelId'] if records else None
+
+    async def set_Traceflag(self, tfid):
+        """ Replaces developer log TraceFlag of the session's user by one traced entity tfid expiring tomorrow """
+        user_id = await self.get_sf_user_id(self._session._username)
+        res = await self.anon_query("SELECT Id FROM TraceFlag WHERE TracedEntityId = '{}'".format(user_id))
+        trace_flag_id = (res.get('records') or [{'Id': None}])[-1]['Id']
+        if trace_flag_id:
+            await self.delete_Traceflag(trace_flag_id)
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        trace_flag = {
+            'ApexCode': 'Finest',
+            'ApexProfiling': 'Error',
+            'Callout': 'Error',
+            'Database': 'Error',
+            'ExpirationDate': expiration.strftime('%Y-%m-%d'),
+            'TracedEntityId': tfid,
+            'Validation': 'Error',
+            'Visualforce': 'Error',
+            'Workflow': 'Error',
+            'System': 'Error',
+            'LogType': 'DEVELOPER_LOG',
+            'DebugLevelId': await self.get_DevDebugLevelId()
+        }
+        return await self.post(SfdcToolingApi._TRACE_FLAG_URI, json.dumps(trace_flag))
+
+    async def delete_Traceflag(self, tfID):
+        return await self.delete(SfdcToolingApi._TRACE_FLAG_URI + '/' + tfID)
+
+    async def execute_AnonApex(self, apex):
+        """ Executes anonymous Apex with a TraceFlag set for the session's user, returns body of the newest log """
+        user_id = await self.get_sf_user_id(self._session._username)
+        trace_flag_id = (await self.set_Traceflag(user_id))['id']
+        await self.anon_apex(apex)
+        log_id = self._get_first_id(await self.anon_query(
+            "SELECT Id FROM ApexLog WHERE LogUserId = '{}' ORDER BY SystemModstamp DESC NULLS LAST LIMIT 1".format(
+                user_id)))
+        body = await self.apexLog_Q(log_id)
+        await self.delete_Traceflag(trace_flag_id)
+        return body
+
+
+class AsyncSfdcBulkApi:
+    """ Asyncio counterpart of SfdcBulkApi """
+    _API_BASE_URI = SfdcBulkApi._API_BASE_URI
+
+    def __init__(self, session, poller=None):
+        if not session.is_connected():
+            raise Exception("Session must be connected prior to instantiating this class")
+        self._session = session
+        self._poller = poller if poller is not None else SfdcPoller()
+
+    def _get_api_uri(self):
+        """ Returns Bulk API base URI for this connection """
+        return self._API_BASE_URI.format(**{'version': self._session.get_api_version()})
+
+    def _get_headers(self, content_type='application/json'):
+        """ Compose HTTP header for request """
+        return {
+            'X-SFDC-Session': self._session.get_session_id(),
+            'Accept-Encoding': 'gzip',
+            'Content-Type': "{0}; charset=UTF-8".format(content_type)
+        }
+
+    async def _request(self, method, uri, expected_status, **kwargs):
+        """ Sends request to Bulk API and checks response status """
+        url = self._session.construct_url(self._get_api_uri() + uri)
+        res = await self._session.request(method, url, **kwargs)
+        if res.status_code != expected_status:
+            raise Exception(
+                "Request failed with %d code and error [%s]" %
+                (res.status_code, res.text))
+        return res
+
+    async def _create_job(self, operation, object_name, content_type, external_id_field=None, pk_chunk_size=None):
+        """ Create a job
+            If pk_chunk_size is passed query will be split into batches by record Id """
+        request = {
+            'operation': operation,
+            'object': object_name,
+            'contentType': content_type
+        }
+
+        if operation == "upsert" and external_id_field is not None:
+            request['externalIdFieldName'] = external_id_field
+
+        headers = self._get_headers()
+        if pk_chunk_size is not None:
+            headers['Sforce-Enable-PKChunking'] = "chunkSize={0}".format(pk_chunk_size)
+
+        res = await self._request('POST', "/job", 201, headers=headers, json=request)
+        return json.loads(res.text)['id']
+
+    async def _close_job(self, job_id):
+        """ Close job """
+        await self._request(
+            'POST', "/job/{0}".format(job_id), 200, headers=self._get_headers(), json={'state': 'Closed'})
+
+    async def _add_batch(self, job_id, data):
+        """ Add batch to job """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        res = await self._request(
+            'POST', "/job/{0}/batch".format(job_id), 201, headers=self._get_headers('text/csv'), data=data)
+        return SfdcBulkApi._parse_batch_id(res.content)
+
+    async def _get_batches(self, job_id):
+        """ Get state of all job's batches """
+        res = await self._request('GET', "/job/{0}/batch".format(job_id), 200, headers=self._get_headers())
+        return SfdcBulkApi._parse_batches(res.content)
+
+    async def _wait_for_batches(self, job_id, batch_ids):
+        """ Waits until all batches are processed, returns their states in the same order """
+        async def poll():
+            states = dict((batch['id'], batch) for batch in await self._get_batches(job_id))
+            return [states[batch_id] for batch_id in batch_ids]
+
+        return await _poll(
+            self._poller, poll,
+            lambda batches: all(batch['state'] in SfdcBulkJobMonitor._FINAL_STATES for batch in batches))
+
+    async def _get_batch_result(self, job_id, batch_id, is_single_job=False):
+        """ Get batch's result, result files are downloaded concurrently """
+        uri = "/job/{0}/batch/{1}/result".format(job_id, batch_id)
+        res = await self._request('GET', uri, 200, headers=self._get_headers())
+        if is_single_job:
+            return res.text
+
+        results = await asyncio.gather(*[
+            self._request('GET', "{0}/{1}".format(uri, result_id), 200, headers=self._get_headers('text/csv'))
+            for result_id in SfdcBulkApi._parse_result_ids(res.content)])
+        return SfdcBulkApi._merge_results([result.text for result in results])
+
+    async def _write_result(self, result, output):
+        """ Writes CSV result to file name or binary file object in a thread, returns number of bytes written """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, SfdcBulkApi._write_chunks, [result.encode('utf-8')], output)
+
+    async def export_object(self, object_name, query=None, output=None):
+        return await self.export(object_name, query, output)
+
+    async def export(self, object_name, query=None, output=None):
+        """ Exports data of specified object
+            If query is not passed only Id field will be exported
+            If output (file name or binary file object) is passed CSV is written to it
+            and number of bytes written is returned """
+        if query is None:
+            query = "SELECT Id FROM {0}".format(object_name)
+
+        # Create async job and add query batch
+        job_id = await self._create_job('query', object_name, 'CSV')
+        batch_id = await self._add_batch(job_id, query)
+        await self._close_job(job_id)
+
+        # Wait until batch is processed
+        status = (await self._wait_for_batches(job_id, [batch_id]))[0]
+
+        if status['state'] == 'Failed':
+            raise Exception("Batch failed: {0}".format(status['message']))
+
+        if status['state'] == 'Not Processed':
+            raise Exception("Batch will not be processed: {0}".format(status['message']))
+
+        if status['processed'] == '0':
+            result = ''
+        else:
+            result = await self._get_batch_result(job_id, batch_id)
+
+        if output is not None:
+            return await self._write_result(result, output)
+        # Return data in CSV format
+        return result
+
+    async def export_chunked(self, object_name, query=None, chunk_size=100000, max_concurrency=4, output=None):
+        """ Exports data of specified object using PK chunking
+            Query is split into batches of chunk_size records by Salesforce and results of
+            up to max_concurrency batches are downloaded concurrently and merged into one CSV.
+            Accepts the same output option as export() """
+        if query is None:
+            query = "SELECT Id FROM {0}".format(object_name)
+
+        # Create async job with PK chunking enabled and add query batch
+        job_id = await self._create_job('query', object_name, 'CSV', pk_chunk_size=chunk_size)
+        batch_id = await self._add_batch(job_id, query)
+
+        def is_done(batches):
+            original = next(batch for batch in batches if batch['id'] == batch_id)
+            if original['state'] == 'Failed':
+                raise Exception("Batch failed: {0}".format(original['message']))
+            # All chunk batches have been created once the original batch is not processed
+            return original['state'] == 'Not Processed' and all(
+                batch['state'] in SfdcBulkJobMonitor._FINAL_STATES for batch in batches)
+
+        # Wait until all chunk batches are processed
+        batches = await _poll(self._poller, lambda: self._get_batches(job_id), is_done)
+        await self._close_job(job_id)
+
+        chunks = [batch for batch in batches if batch['id'] != batch_id]
+        for batch in chunks:
+            if batch['state'] in ['Failed', 'Not Processed']:
+                raise Exception("Batch failed: {0}".format(batch['message']))
+
+        async def download(batch):
+            return [await self._get_batch_result(job_id, batch['id'])]
+
+        results = await _dispatch(download, [batch for batch in chunks if batch['processed'] != '0'], max_concurrency)
+        result = SfdcBulkApi._merge_results(results) if results else ''
+
+        if output is not None:
+            return await self._write_result(result, output)
+        # Return data in CSV format
+        return result
+
+    async def _load(self, operation, object_name, csv_data, external_id_field=None, max_concurrency=4):
+        """ Loads data to specified object using passed operation
+            Input is split into batches which are submitted to one job concurrently, at most
+            max_concurrency batches are being uploaded and one more is waiting to be uploaded at once """
+        job_id = await self._create_job(operation, object_name, 'CSV', external_id_field)
+
+        loop = asyncio.get_event_loop()
+        batches = SfdcBulkApi._split_batches(csv_data)
+        queue = asyncio.Queue(1)
+        batch_ids = []
+
+        async def produce():
+            while True:
+                # Input is read and split in a thread so reading a file does not block the event loop
+                data = await loop.run_in_executor(None, next, batches, None)
+                if data is None:
+                    break
+                batch_ids.append(None)
+                await queue.put((len(batch_ids) - 1, data))
+            for _ in range(max_concurrency):
+                await queue.put(None)
+
+        async def consume():
+            item = await queue.get()
+            while item is not None:
+                index, data = item
+                batch_ids[index] = await self._add_batch(job_id, data)
+                item = await queue.get()
+
+        tasks = [asyncio.ensure_future(produce())]
+        tasks.extend(asyncio.ensure_future(consume()) for _ in range(max_concurrency))
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+        await self._close_job(job_id)
+
+        # Wait until batches are processed
+        status = SfdcBulkApi._aggregate_status(operation, await self._wait_for_batches(job_id, batch_ids))
+
+        result_batch_ids = SfdcBulkApi._get_result_batch_ids(status)
+        if result_batch_ids:
+            SfdcBulkApi._set_results(status, result_batch_ids, await asyncio.gather(*[
+                self._get_batch_result(job_id, batch_id, True) for batch_id in result_batch_ids]))
+
+        SfdcBulkApi._check_status(status)
+        return status
+
+    async def upsert(self, object_name, csv_data, external_id_field, max_concurrency=4):
+        """ Upserts data to specified object
+            Records will be matched by external id field """
+        return await self._load('upsert', object_name, csv_data, external_id_field, max_concurrency)
+
+    async def update(self, object_name, csv_data, max_concurrency=4):
+        """ Updates data in specified object
+            Records will be matched by id field """
+        return await self._load('update', object_name, csv_data, max_concurrency=max_concurrency)
+
+    async def delete(self, object_name, csv_data, max_concurrency=4):
+        """ Deletes data from specified object
+            Records will be matched by id field """
+        return await self._load('delete', object_name, csv_data, max_concurrency=max_concurrency)
+
+
+class AsyncSfdcMetadataApi:
+    """ Asyncio counterpart of SfdcMetadataApi """
+
+    def __init__(self, session, poller=None):
+        if not session.is_connected():
+            raise Exception("Session must be connected prior to instantiating this class")
+        self._session = session
+        self._poller = poller if poller is not None else SfdcPoller()
+
+    def _get_api_url(self):
+        return "%s%s" % (
+            self._session.get_server_url(),
+            SfdcMetadataApi._METADATA_API_BASE_URI.format(**{'version': self._session.get_api_version()}))
+
+    async def _call(self, action, request):
+        """ Sends SOAP request """
+        headers = {'Content-type': 'text/xml', 'SOAPAction': action}
+        res = await self._session.post(self._get_api_url(), headers=headers, data=request)
+        if res.status_code != 200:
+            raise Exception(
+                "Request failed with %d code and error [%s]" %
+                (res.status_code, res.text))
+        return res
+
+    async def deploy(self, zipfile, options):
+        """ Kicks off async deployment, returns deployment id """
+        attributes = SfdcMetadataApi._get_deploy_attributes(self._session, options)
+        attributes['ZipFile'] = SfdcMetadataApi._read_deploy_zip(zipfile)
+        res = await self._call('deploy', msg.DEPLOY_MSG.format(**attributes))
+        return parse_async_result(res.content, 'deployResponse')
+
+    async def _retrieve_deploy_result(self, async_process_id, include_details=True):
+        """ Retrieves status for specified deployment id as DeployResult """
+        attributes = {
+            'client': 'Metahelper',
+            'sessionId': self._session.get_session_id(),
+            'asyncProcessId': async_process_id,
+            'includeDetails': 'true' if include_details else 'false'
+        }
+        res = await self._call('checkDeployStatus', msg.CHECK_DEPLOY_STATUS_MSG.format(**attributes))
+        return parse_deploy_result(res.content)
+
+    async def check_deploy_status(self, async_process_id):
+        """ Checks whether deployment succeeded """
+        return (await self._retrieve_deploy_result(async_process_id)).to_status()
+
+    async def deploy_and_wait(self, zipfile, options, callback=None):
+        """ Deploys ZIP file and waits until deployment is finished
+            If callback is passed it is called with every event of watch_deploy()
+            Returns the same 4-tuple as check_deploy_status() """
+        async_process_id, state = await self.deploy(zipfile, options)
+        async for event in self.watch_deploy(async_process_id):
+            if callback is not None:
+                callback(event)
+            if event['event'] == 'done':
+                return event['status']
+
+    def watch_deploy(self, async_process_id):
+        """ Returns asynchronous iterator (async for) of the same events as SfdcMetadataApi.watch_deploy() """
+        return AsyncSfdcDeployWatcher(self, async_process_id)
+
+    async def retrieve(self, options):
+        """ Submits retrieve request """
+        attributes = SfdcMetadataApi._get_retrieve_attributes(self._session, options)
+        res = await self._call('retrieve', msg.RETRIEVE_MSG.format(**attributes))
+        return parse_async_result(res.content, 'retrieveResponse')
+
+    async def _retrieve_retrieve_result(self, async_process_id, include_zip):
+        """ Retrieves status for specified retrieval id """
+        attributes = {
+            'client': 'Metahelper',
+            'sessionId': self._session.get_session_id(),
+            'asyncProcessId': async_process_id,
+            'includeZip': include_zip
+        }
+        res = await self._call('checkRetrieveStatus', msg.CHECK_RETRIEVE_STATUS_MSG.format(**attributes))
+        return parse_retrieve_result(res.content)
+
+    async def check_retrieve_status(self, async_process_id):
+        """ Checks whether retrieval succeeded """
+        return (await self._retrieve_retrieve_result(async_process_id, 'false')).to_status()
+
+    async def retrieve_zip_to(self, async_process_id, output):
+        """ Retrieves ZIP file and writes it to file name or binary file object
+            Response is decoded and written in a thread so the event loop is not blocked
+            Returns the same 3-tuple as check_retrieve_status() """
+        attributes = {
+            'client': 'Metahelper',
+            'sessionId': self._session.get_session_id(),
+            'asyncProcessId': async_process_id,
+            'includeZip': 'true'
+        }
+        res = await self._call('checkRetrieveStatus', msg.CHECK_RETRIEVE_STATUS_MSG.format(**attributes))
+        size = _RetrieveResultParser.CHUNK_SIZE
+        chunks = [res.content[i:i + size] for i in range(0, len(res.content), size)]
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, SfdcMetadataApi._write_retrieve_result, chunks, output)
+
+    async def retrieve_zip(self, async_process_id):
+        """ Retrieves ZIP file """
+        result = await self._retrieve_retrieve_result(async_process_id, 'true')
+        return result.to_status() + (result.get_zip(),)
+
+    async def retrieve_and_wait(self, options, output=None):
+        """ Submits retrieve request and waits until it is finished
+            Accepts the same output option as SfdcMetadataApi.retrieve_and_wait() """
+        async_process_id, state = await self.retrieve(options)
+        state, error_message, messages = await _poll(
+            self._poller, lambda: self.check_retrieve_status(async_process_id),
+            lambda status: status[0] in SfdcMetadataApi._RETRIEVE_FINAL_STATES)
+        if state != 'Succeeded':
+            return state, error_message, messages, None
+        if output is not None:
+            return (await self.retrieve_zip_to(async_process_id, output)) + (None,)
+        return await self.retrieve_zip(async_process_id)
+
+
+class AsyncSfdcDeployWatcher:
+    """ Asynchronous iterator of deployment progress events, see SfdcMetadataApi.watch_deploy() """
+
+    def __init__(self, metadata, async_process_id):
+        self._metadata = metadata
+        self._async_process_id = async_process_id
+        self._delays = None
+        self._progress = _DeployProgress()
+        self._events = deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._events:
+            if self._progress.is_done:
+                raise StopAsyncIteration
+            if self._delays is None:
+                self._delays = self._metadata._poller.delays()
+            else:
+                delay = next(self._delays, None)
+                if delay is None:
+                    raise self._metadata._poller.get_timeout_error()
+                await asyncio.sleep(delay)
+            events, has_details = self._progress.update(
+                await self._metadata._retrieve_deploy_result(self._async_process_id, False))
+            self._events.extend(events)
+            if has_details:
+                self._events.extend(self._progress.add_details(
+                    await self._metadata._retrieve_deploy_result(self._async_process_id)))
+        return self._events.popleft()
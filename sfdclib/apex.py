@@ -0,0 +1,289 @@
+""" Class to run anonymous Apex with debug logs """
+import datetime
+import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from sfdclib.tooling import SfdcToolingApi
+
+
+class SfdcApexRunner:
+    """ Runs anonymous Apex and returns its debug log
+        User id and DebugLevel id are looked up once and a long-lived TraceFlag is reused, every run takes
+        a Composite request executing Apex and finding its log plus a request downloading log body
+        Executed Apex is prefixed with System.debug() printing a unique marker which identifies its log """
+    _TRACE_FLAG_LIFETIME = datetime.timedelta(hours=23)
+    _TRACE_FLAG_MARGIN = datetime.timedelta(minutes=10)
+    _DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.000+0000'
+    _TRACE_FLAG_LEVELS = {
+        'ApexCode': 'Finest',
+        'ApexProfiling': 'Error',
+        'Callout': 'Error',
+        'Database': 'Error',
+        'Validation': 'Error',
+        'Visualforce': 'Error',
+        'Workflow': 'Error',
+        'System': 'Error'
+    }
+
+    def __init__(self, session, debug_level_id=None, keep_trace_flag=True):
+        self._tooling = SfdcToolingApi(session)
+        self._session = session
+        self._debug_level_id = debug_level_id
+        self._keep_trace_flag = keep_trace_flag
+        self._user_id = None
+        self._trace_flag_id = None
+        self._trace_flag_expiration = None
+        self._is_trace_flag_created = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _parse_date(value):
+        return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+    @staticmethod
+    def _get_first_record(res):
+        records = res.get('records') or []
+        return records[0] if records else None
+
+    def get_user_id(self):
+        """ Returns id of the session's user """
+        if self._user_id is None:
+            record = self._get_first_record(self._tooling.anon_query(
+                "SELECT Id FROM User WHERE Username = '%s'" % self._session._username.replace("'", "\\'")))
+            if record is None:
+                raise Exception("User %s was not found" % self._session._username)
+            self._user_id = record['Id']
+        return self._user_id
+
+    def get_debug_level_id(self):
+        """ Returns id of DebugLevel used by TraceFlag
+            DebugLevel of an existing developer log TraceFlag is used unless it was passed to the constructor """
+        if self._debug_level_id is None:
+            record = self._get_first_record(self._tooling.anon_query(
+                "SELECT DebugLevelId FROM TraceFlag WHERE LogType = 'DEVELOPER_LOG' LIMIT 1"))
+            if record is not None:
+                self._debug_level_id = record['DebugLevelId']
+            else:
+                record = self._get_first_record(self._tooling.anon_query(
+                    "SELECT Id FROM DebugLevel WHERE DeveloperName = 'SFDC_DevConsole'"))
+                if record is None:
+                    raise Exception("DebugLevel could not be found, pass debug_level_id to the constructor")
+                self._debug_level_id = record['Id']
+        return self._debug_level_id
+
+    def ensure_trace_flag(self):
+        """ Makes sure developer log TraceFlag of the user is active
+            Existing TraceFlag is reused while it does not expire, otherwise it is replaced by a new one """
+        with self._lock:
+            now = datetime.datetime.utcnow()
+            if self._trace_flag_expiration is not None and \
+                    self._trace_flag_expiration - now > self._TRACE_FLAG_MARGIN:
+                return self._trace_flag_id
+
+            user_id = self.get_user_id()
+            res = self._tooling.anon_query(
+                "SELECT Id, ExpirationDate FROM TraceFlag WHERE TracedEntityId = '%s' "
+                "AND LogType = 'DEVELOPER_LOG'" % user_id, cache_ttl=0)
+            for record in res.get('records') or []:
+                expiration = self._parse_date(record['ExpirationDate'])
+                if expiration - now > self._TRACE_FLAG_MARGIN:
+                    self._trace_flag_id, self._trace_flag_expiration = record['Id'], expiration
+                    return self._trace_flag_id
+                self._tooling.delete_Traceflag(record['Id'])
+
+            expiration = now + self._TRACE_FLAG_LIFETIME
+            trace_flag = dict(self._TRACE_FLAG_LEVELS)
+            trace_flag.update({
+                'DebugLevelId': self.get_debug_level_id(),
+                'LogType': 'DEVELOPER_LOG',
+                'StartDate': now.strftime(self._DATE_FORMAT),
+                'ExpirationDate': expiration.strftime(self._DATE_FORMAT),
+                'TracedEntityId': user_id
+            })
+            res = self._tooling.post(SfdcToolingApi._TRACE_FLAG_URI, json.dumps(trace_flag))
+            if not isinstance(res, dict) or 'id' not in res:
+                raise Exception("TraceFlag could not be created: %s" % res)
+            self._trace_flag_id, self._trace_flag_expiration = res['id'], expiration
+            self._is_trace_flag_created = True
+            return self._trace_flag_id
+
+    def _get_execute_subrequest(self, apex, reference_id):
+        return {
+            'method': 'GET',
+            'url': self._tooling.get_api_path(SfdcToolingApi._EXECUTE_ANON_APEX_URI.format(
+                **{'a': urlencode({'anonymousBody': apex})})),
+            'referenceId': reference_id
+        }
+
+    def _get_query_subrequest(self, query, reference_id):
+        return {
+            'method': 'GET',
+            'url': self._tooling.get_api_path(SfdcToolingApi._ANON_QUERY_URI.format(
+                **{'query': urlencode({'q': query})})),
+            'referenceId': reference_id
+        }
+
+    @staticmethod
+    def _get_subrequest_body(response):
+        """ Returns body of composite subrequest response, raises an exception if it failed """
+        if response['httpStatusCode'] >= 300:
+            raise Exception("Subrequest %s failed: %s" % (response['referenceId'], response['body']))
+        return response['body']
+
+    def get_log(self, log_id):
+        """ Downloads body of ApexLog """
+        return self._tooling.apexLog_Q(log_id)
+
+    @staticmethod
+    def _get_marker_prefix(marker):
+        return "System.debug(LoggingLevel.ERROR, '%s'); " % marker
+
+    @staticmethod
+    def _init_result(result, prefix):
+        """ Adds log_id and log keys to executeAnonymous result and corrects column shifted by the marker """
+        result = dict(result)
+        # Marker is put on the first line so only columns of the first line are shifted
+        if result.get('line') == 1 and result.get('column', -1) > len(prefix):
+            result['column'] -= len(prefix)
+        result['log_id'] = None
+        result['log'] = None
+        return result
+
+    def _get_watermark_query(self):
+        return "SELECT Id, SystemModstamp FROM ApexLog WHERE LogUserId = '%s' " \
+               "ORDER BY SystemModstamp DESC LIMIT 1" % self.get_user_id()
+
+    def _get_log_query(self, watermark=None):
+        """ Returns query of executeAnonymous logs of the user created after the watermark log """
+        query = "SELECT Id FROM ApexLog WHERE LogUserId = '%s' " \
+                "AND Operation LIKE '%%executeAnonymous%%'" % self.get_user_id()
+        if watermark is not None:
+            query += " AND SystemModstamp >= %s AND Id != '%s'" % (watermark['SystemModstamp'], watermark['Id'])
+        return query
+
+    def run(self, apex, fetch_log=True):
+        """ Executes anonymous Apex
+            Returns executeAnonymous result with log_id and log keys added,
+            they are None if Apex did not compile or no log was found.
+            Newest log found together with the execution is used if it contains the marker, otherwise logs
+            created after the execution started are queried again. If fetch_log is False the marker is not
+            checked and the newest log created after the execution started is returned """
+        self.ensure_trace_flag()
+        marker = 'sfdclib-run:%s' % uuid.uuid4().hex
+        prefix = self._get_marker_prefix(marker)
+        responses = self._tooling.composite([
+            self._get_query_subrequest(self._get_watermark_query(), 'watermark'),
+            self._get_execute_subrequest(prefix + apex, 'execute'),
+            self._get_query_subrequest(self._get_log_query() + " ORDER BY SystemModstamp DESC LIMIT 1", 'log')
+        ])
+        watermark = self._get_first_record(self._get_subrequest_body(responses[0]))
+        result = self._init_result(self._get_subrequest_body(responses[1]), prefix)
+        record = self._get_first_record(self._get_subrequest_body(responses[2]))
+        if not result.get('compiled'):
+            return result
+
+        checked = set()
+        if record is not None and (watermark is None or record['Id'] != watermark['Id']):
+            if not fetch_log:
+                result['log_id'] = record['Id']
+                return result
+            log = self.get_log(record['Id'])
+            if marker in log:
+                result['log_id'], result['log'] = record['Id'], log
+                return result
+            checked.add(record['Id'])
+
+        # Log was not written yet or another execution's log was found
+        records = self._tooling.anon_query_all(
+            self._get_log_query(watermark) + " ORDER BY SystemModstamp DESC")
+        for record in records:
+            if record['Id'] in checked:
+                continue
+            if not fetch_log:
+                result['log_id'] = record['Id']
+                break
+            log = self.get_log(record['Id'])
+            if marker in log:
+                result['log_id'], result['log'] = record['Id'], log
+                break
+        return result
+
+    def _get_log_watermark(self):
+        """ Returns Id and SystemModstamp of the newest ApexLog of the user or None """
+        return self._get_first_record(self._tooling.anon_query(self._get_watermark_query(), cache_ttl=0))
+
+    def run_batch(self, apex_bodies, max_workers=4, fetch_logs=True):
+        """ Executes many anonymous Apex bodies running up to max_workers at once
+            Every body is prefixed with System.debug() call printing a unique marker, logs created
+            by the batch are downloaded concurrently and matched to executions by the marker until all are found
+            Returns list of results in the same order and shape as run() """
+        self.ensure_trace_flag()
+        watermark = self._get_log_watermark() if fetch_logs else None
+        markers = ['sfdclib-run:%s' % uuid.uuid4().hex for _ in apex_bodies]
+
+        def execute(marker, apex):
+            prefix = self._get_marker_prefix(marker)
+            return self._init_result(self._tooling.anon_apex(prefix + apex), prefix)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(execute, markers, apex_bodies))
+            expected = dict((marker, result) for marker, result in zip(markers, results) if result.get('compiled'))
+            if not fetch_logs or not expected:
+                return results
+
+            # Logs not written yet when queried first are looked for once more, as run() does
+            checked = set()
+            for _ in range(2):
+                log_ids = [record['Id'] for record in self._tooling.anon_query_all(self._get_log_query(watermark))
+                           if record['Id'] not in checked]
+                checked.update(log_ids)
+                self._match_logs(executor, log_ids, expected, max_workers)
+                if not expected:
+                    break
+        return results
+
+    def _match_logs(self, executor, log_ids, expected, max_workers):
+        """ Downloads logs up to max_workers at once and sets them to results of expected markers they contain
+            Matched markers are removed from expected and no more logs are downloaded once it is empty """
+        pending = []
+        log_ids = iter(log_ids)
+        try:
+            while expected:
+                for log_id in log_ids:
+                    pending.append((log_id, executor.submit(self.get_log, log_id)))
+                    if len(pending) >= max_workers:
+                        break
+                if not pending:
+                    break
+                log_id, future = pending.pop(0)
+                log = future.result()
+                for marker in list(expected):
+                    if marker in log:
+                        result = expected.pop(marker)
+                        result['log_id'] = log_id
+                        result['log'] = log
+                        break
+        finally:
+            for log_id, future in pending:
+                future.cancel()
+
+    def close(self):
+        """ Deletes TraceFlag created by this runner unless keep_trace_flag is True """
+        with self._lock:
+            if self._is_trace_flag_created and not self._keep_trace_flag:
+                self._tooling.delete_Traceflag(self._trace_flag_id)
+                self._trace_flag_id = None
+                self._trace_flag_expiration = None
+                self._is_trace_flag_created = False
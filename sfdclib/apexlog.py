@@ -0,0 +1,105 @@
+""" Class to download Apex debug logs in bulk """
+import gzip
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sfdclib.poller import SfdcPoller
+from sfdclib.tooling import SfdcToolingApi
+
+
+class SfdcApexLogHarvester:
+    """ Lists ApexLog records newer than a SystemModstamp watermark and downloads their bodies
+        concurrently into a directory, bodies are streamed to disk and optionally gzip compressed """
+    _LOG_FIELDS = ['Id', 'LogUserId', 'Operation', 'Request', 'Status', 'LogLength', 'StartTime', 'SystemModstamp']
+
+    def __init__(self, session, directory, where=None, since=None, compress=False, max_workers=4, poller=None):
+        self._tooling = SfdcToolingApi(session)
+        self._directory = directory
+        self._where = where
+        self._compress = compress
+        self._max_workers = max_workers
+        self._poller = poller if poller is not None else SfdcPoller(initial_interval=2.0, max_interval=60.0)
+        # Logs having the same SystemModstamp as watermark which were already listed
+        self._watermark = since
+        self._watermark_ids = set()
+
+    def get_watermark(self):
+        """ Returns SystemModstamp of the newest listed log """
+        return self._watermark
+
+    def get_path(self, log_id):
+        """ Returns path log body is written to """
+        return os.path.join(self._directory, "{0}.log{1}".format(log_id, '.gz' if self._compress else ''))
+
+    def list_logs(self):
+        """ Lists logs modified since watermark and moves watermark to the newest of them """
+        conditions = []
+        if self._where:
+            conditions.append("(%s)" % self._where)
+        if self._watermark is not None:
+            conditions.append("SystemModstamp >= %s" % self._watermark)
+        query = "SELECT {0} FROM ApexLog".format(', '.join(self._LOG_FIELDS))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY SystemModstamp, Id"
+
+        logs = []
+        for record in self._tooling.anon_query_all(query):
+            if record['SystemModstamp'] == self._watermark and record['Id'] in self._watermark_ids:
+                continue
+            logs.append(record)
+        if logs:
+            newest = logs[-1]['SystemModstamp']
+            if newest != self._watermark:
+                self._watermark = newest
+                self._watermark_ids = set()
+            self._watermark_ids.update(log['Id'] for log in logs if log['SystemModstamp'] == newest)
+        return logs
+
+    def download(self, log_id):
+        """ Streams log body to its file, returns path of the file
+            Body is written to a temporary file first so incomplete logs are never left behind """
+        path = self.get_path(log_id)
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        handle, temp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                if self._compress:
+                    with gzip.GzipFile(filename=os.path.basename(path)[:-3], mode='wb', fileobj=file) as output:
+                        self._tooling.download_apex_log(log_id, output)
+                else:
+                    self._tooling.download_apex_log(log_id, file)
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return path
+
+    def harvest(self):
+        """ Downloads logs modified since the previous call using up to max_workers concurrent requests
+            Returns list of (log record, path) tuples """
+        logs = self.list_logs()
+        if not logs:
+            return []
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            paths = list(executor.map(self.download, [log['Id'] for log in logs]))
+        return list(zip(logs, paths))
+
+    def follow(self):
+        """ Yields (log record, path) tuples of new logs as they appear
+            Polling interval grows while there are no new logs and is reset when some arrive.
+            Stops if no new log appears within poller's timeout """
+        delays = self._poller.delays()
+        while True:
+            harvested = self.harvest()
+            for item in harvested:
+                yield item
+            if harvested:
+                delays = self._poller.delays()
+            delay = next(delays, None)
+            if delay is None:
+                return
+            time.sleep(delay)
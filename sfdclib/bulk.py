@@ -1,21 +1,32 @@
 """ Class to work with Salesforce Bulk API """
+import codecs
+import csv
+import io
 import json
-import time
-from xml.etree import ElementTree as ET
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from sfdclib.parsers import parse_batch_info, parse_batch_info_list, parse_result_list
+from sfdclib.poller import SfdcPoller
 
 
 class SfdcBulkApi:
     """ Class to work with Salesforce Bulk API """
     _API_BASE_URI = "/services/async/{version}"
     _SOQL_QUERY_URI = "/query/?{query}"
-    _XML_NAMESPACES = {
-        'asyncapi': 'http://www.force.com/2009/06/asyncapi/dataload'
-    }
+    _DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+    _MAX_BATCH_RECORDS = 10000
+    _MAX_BATCH_SIZE = 10000000
 
-    def __init__(self, session):
+    def __init__(self, session, poller=None):
         if not session.is_connected():
             raise Exception("Session must be connected prior to instantiating this class")
         self._session = session
+        self._poller = poller if poller is not None else SfdcPoller()
+
+    def get_poller(self):
+        """ Returns poller used to wait for jobs """
+        return self._poller
 
     def _get_api_uri(self):
         """ Returns Bulk API base URI for this connection """
@@ -29,8 +40,9 @@ class SfdcBulkApi:
             'Content-Type': "{0}; charset=UTF-8".format(content_type)
         }
 
-    def _create_job(self, operation, object_name, content_type, external_id_field=None):
-        """ Create a job """
+    def _create_job(self, operation, object_name, content_type, external_id_field=None, pk_chunk_size=None):
+        """ Create a job
+            If pk_chunk_size is passed query will be split into batches by record Id """
         request = {
             'operation': operation,
             'object': object_name,
@@ -40,8 +52,12 @@ class SfdcBulkApi:
         if operation == "upsert" and external_id_field is not None:
             request['externalIdFieldName'] = external_id_field
 
+        headers = self._get_headers()
+        if pk_chunk_size is not None:
+            headers['Sforce-Enable-PKChunking'] = "chunkSize={0}".format(pk_chunk_size)
+
         url = self._session.construct_url(self._get_api_uri() + "/job")
-        res = self._session.post(url, headers=self._get_headers(), json=request)
+        res = self._session.post(url, headers=headers, json=request)
         if res.status_code != 201:
             raise Exception(
                 "Request failed with %d code and error [%s]" %
@@ -63,18 +79,25 @@ class SfdcBulkApi:
 
     def _add_batch(self, job_id, data):
         """ Add batch to job """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
         url = self._session.construct_url(self._get_api_uri() + "/job/{0}/batch".format(job_id))
-        res = self._session.post(url, headers=self._get_headers('text/csv'), data=data.encode('utf-8'))
+        res = self._session.post(url, headers=self._get_headers('text/csv'), data=data)
 
         if res.status_code != 201:
             raise Exception(
                 "Request failed with %d code and error [%s]" %
                 (res.status_code, res.text))
 
-        return ET.fromstring(res.text).find('asyncapi:id', self._XML_NAMESPACES).text
+        return self._parse_batch_id(res.content)
 
-    def _get_batch_state(self, job_id, batch_id):
-        """ Get batch's state """
+    @staticmethod
+    def _parse_batch_id(text):
+        """ Parses batch info returned when batch is added """
+        return parse_batch_info(text).id
+
+    def _get_batches(self, job_id):
+        """ Get state of all job's batches """
         url = self._session.construct_url(self._get_api_uri() + "/job/{0}/batch".format(job_id))
         res = self._session.get(url, headers=self._get_headers())
 
@@ -83,29 +106,43 @@ class SfdcBulkApi:
                 "Request failed with %d code and error [%s]" %
                 (res.status_code, res.text))
 
-        batches = ET.fromstring(res.text).findall('asyncapi:batchInfo', self._XML_NAMESPACES)
-        for batch in batches:
-            if batch_id == batch.find('asyncapi:id', self._XML_NAMESPACES).text:
-                state = batch.find('asyncapi:state', self._XML_NAMESPACES).text
-                message = batch.find('asyncapi:stateMessage', self._XML_NAMESPACES)
-                processed_count = batch.find('asyncapi:numberRecordsProcessed', self._XML_NAMESPACES).text
-                failed_count = batch.find('asyncapi:numberRecordsFailed', self._XML_NAMESPACES).text
-                if message is not None:
-                    message = message.text
-                else:
-                    message = None
+        return self._parse_batches(res.content)
+
+    @staticmethod
+    def _parse_batches(text):
+        """ Parses batch list into BatchInfo objects """
+        return parse_batch_info_list(text)
+
+    def _get_batch_state(self, job_id, batch_id):
+        """ Get batch's state """
+        for batch in self._get_batches(job_id):
+            if batch_id == batch['id']:
                 return {
-                    'state': state,
-                    'message': message,
-                    'processed': processed_count,
-                    'failed': failed_count
+                    'state': batch['state'],
+                    'message': batch['message'],
+                    'processed': batch['processed'],
+                    'failed': batch['failed']
                 }
 
         raise Exception("Batch was not found")
 
     def _get_batch_result(self, job_id, batch_id, is_single_job=False):
         """ Get batch's result """
-        # Get result Id first
+        if is_single_job:
+            url = self._session.construct_url(
+                self._get_api_uri() + "/job/{0}/batch/{1}/result".format(job_id, batch_id))
+            res = self._session.get(url, headers=self._get_headers())
+
+            if res.status_code != 200:
+                raise Exception(
+                    "Request failed with %d code and error [%s]" %
+                    (res.status_code, res.text))
+            return res.text
+
+        return b''.join(self._iter_batch_result(job_id, batch_id)).decode('utf-8')
+
+    def _get_result_ids(self, job_id, batch_id):
+        """ Get Ids of all batch's results """
         url = self._session.construct_url(self._get_api_uri() + "/job/{0}/batch/{1}/result".format(job_id, batch_id))
         res = self._session.get(url, headers=self._get_headers())
 
@@ -114,29 +151,206 @@ class SfdcBulkApi:
                 "Request failed with %d code and error [%s]" %
                 (res.status_code, res.text))
 
-        if is_single_job:
-            return res.text
+        return self._parse_result_ids(res.content)
 
-        result_id = ET.fromstring(res.text).find('asyncapi:result', self._XML_NAMESPACES).text
+    @staticmethod
+    def _parse_result_ids(text):
+        """ Parses result list """
+        return parse_result_list(text)
 
-        # Download CSV
+    def _iter_result(self, job_id, batch_id, result_id):
+        """ Yields one of batch's results as raw CSV byte chunks """
+        # Download CSV without loading it into memory
         url = self._session.construct_url(
             self._get_api_uri() + "/job/{0}/batch/{1}/result/{2}".format(job_id, batch_id, result_id))
-        res = self._session.get(url, headers=self._get_headers('text/csv'))
-
-        if res.status_code != 200:
-            raise Exception(
-                "Request failed with %d code and error [%s]" %
-                (res.status_code, res.text))
-        # TODO: Replace with stream object
-        return res.text
-
-    def export_object(self, object_name, query=None):
-        return self.export(object_name, query)
-
-    def export(self, object_name, query=None):
+        res = self._session.get(url, headers=self._get_headers('text/csv'), stream=True)
+
+        try:
+            if res.status_code != 200:
+                raise Exception(
+                    "Request failed with %d code and error [%s]" %
+                    (res.status_code, res.text))
+            for chunk in res.iter_content(self._DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+        finally:
+            res.close()
+
+    def _iter_batch_result(self, job_id, batch_id, max_workers=4):
+        """ Yields batch's result as raw CSV byte chunks
+            Salesforce splits large query results into several files, these are downloaded
+            concurrently and merged in order, one after another if max_workers is 1 """
+        result_ids = self._get_result_ids(job_id, batch_id)
+        if len(result_ids) == 1 or max_workers == 1:
+            for index, result_id in enumerate(result_ids):
+                chunks = self._iter_result(job_id, batch_id, result_id)
+                for chunk in chunks if index == 0 else self._skip_header(chunks):
+                    yield chunk
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(self._spool_result, job_id, batch_id, result_id) for result_id in result_ids]
+        for chunk in self._iter_spooled_results(executor, futures):
+            yield chunk
+
+    @staticmethod
+    def _skip_header(chunks):
+        """ Yields byte chunks without their first line, used for all but the first result of a batch """
+        is_header = True
+        for chunk in chunks:
+            if is_header:
+                end = chunk.find(b'\n')
+                if end == -1:
+                    continue
+                is_header = False
+                chunk = chunk[end + 1:]
+            if chunk:
+                yield chunk
+
+    def _spool(self, chunks):
+        """ Writes byte chunks into a temporary file """
+        file = tempfile.TemporaryFile()
+        try:
+            self._write_chunks(chunks, file)
+        except Exception:
+            file.close()
+            raise
+        file.seek(0)
+        return file
+
+    def _spool_result(self, job_id, batch_id, result_id):
+        """ Downloads one of batch's results into a temporary file """
+        return self._spool(self._iter_result(job_id, batch_id, result_id))
+
+    def _spool_batch_result(self, job_id, batch_id, max_workers=4):
+        """ Downloads batch's result into a temporary file """
+        return self._spool(self._iter_batch_result(job_id, batch_id, max_workers))
+
+    def _iter_spooled_results(self, executor, futures):
+        """ Yields content of spooled results in order, CSV header is only kept for the first one """
+        try:
+            is_first = True
+            while futures:
+                file = futures.pop(0).result()
+                try:
+                    if not is_first:
+                        file.readline()
+                    is_first = False
+                    chunk = file.read(self._DOWNLOAD_CHUNK_SIZE)
+                    while chunk:
+                        yield chunk
+                        chunk = file.read(self._DOWNLOAD_CHUNK_SIZE)
+                finally:
+                    file.close()
+        finally:
+            self._discard_spooled_results(executor, futures)
+
+    @staticmethod
+    def _discard_spooled_results(executor, futures):
+        """ Cancels pending downloads and removes results which have already been spooled """
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for future in futures:
+            if not future.cancelled() and future.exception() is None:
+                future.result().close()
+
+    @staticmethod
+    def _iter_lines(chunks):
+        """ Decodes byte chunks and yields lines including line terminators """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        pending = ''
+        for chunk in chunks:
+            pending += decoder.decode(chunk)
+            lines = pending.split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        pending += decoder.decode(b'', True)
+        if pending:
+            yield pending
+
+    @staticmethod
+    def _iter_rows(chunks):
+        """ Yields CSV rows parsed from byte chunks """
+        for row in csv.reader(SfdcBulkApi._iter_lines(chunks)):
+            yield row
+
+    @staticmethod
+    def _iter_input_rows(csv_data):
+        """ Yields CSV rows of string, file object or iterable of rows """
+        if isinstance(csv_data, (bytes, bytearray)):
+            csv_data = csv_data.decode('utf-8')
+        if isinstance(csv_data, str):
+            return csv.reader(io.StringIO(csv_data))
+        if hasattr(csv_data, 'read'):
+            if isinstance(csv_data.read(0), bytes):
+                chunks = iter(lambda: csv_data.read(SfdcBulkApi._DOWNLOAD_CHUNK_SIZE), b'')
+                return SfdcBulkApi._iter_rows(chunks)
+            return csv.reader(csv_data)
+        return iter(csv_data)
+
+    @staticmethod
+    def _serialize_row(row):
+        """ Converts row into CSV encoded bytes """
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerow(row)
+        return buffer.getvalue().encode('utf-8')
+
+    @staticmethod
+    def _split_batches(csv_data):
+        """ Splits input data into CSV batches respecting Salesforce batch limits
+            First row is treated as a header and is repeated in every batch """
+        rows = SfdcBulkApi._iter_input_rows(csv_data)
+        try:
+            header = SfdcBulkApi._serialize_row(next(rows))
+        except StopIteration:
+            return
+
+        batch = [header]
+        size = len(header)
+        for row in rows:
+            if not row:
+                continue
+            line = SfdcBulkApi._serialize_row(row)
+            if len(batch) > 1 and (
+                    len(batch) > SfdcBulkApi._MAX_BATCH_RECORDS or size + len(line) > SfdcBulkApi._MAX_BATCH_SIZE):
+                yield b''.join(batch)
+                batch = [header]
+                size = len(header)
+            batch.append(line)
+            size += len(line)
+        if len(batch) > 1:
+            yield b''.join(batch)
+
+    @staticmethod
+    def _write_chunks(chunks, output):
+        """ Writes byte chunks to file name or file object, returns number of bytes written """
+        if hasattr(output, 'write'):
+            file = output
+            should_close = False
+        else:
+            file = open(output, 'wb')
+            should_close = True
+        size = 0
+        try:
+            for chunk in chunks:
+                file.write(chunk)
+                size += len(chunk)
+        finally:
+            if should_close:
+                file.close()
+        return size
+
+    def export_object(self, object_name, query=None, **kwargs):
+        return self.export(object_name, query, **kwargs)
+
+    def export(self, object_name, query=None, stream=False, raw=False, output=None, max_workers=4):
         """ Exports data of specified object
-            If query is not passed only Id field will be exported """
+            If query is not passed only Id field will be exported
+            Result files are downloaded using up to max_workers concurrent requests
+            If stream is True a generator of CSV rows (or raw byte chunks if raw is True) is returned
+            If output (file name or binary file object) is passed CSV is written to it
+            and number of bytes written is returned """
         if query is None:
             query = "SELECT Id FROM {0}".format(object_name)
 
@@ -146,93 +360,248 @@ class SfdcBulkApi:
         self._close_job(job_id)
 
         # Wait until batch is processed
-        status = self._get_batch_state(job_id, batch_id)
-        while status['state'] not in ['Completed', 'Failed', 'Not Processed']:
-            time.sleep(5)
-            status = self._get_batch_state(job_id, batch_id)
+        status = self.monitor(job_id, [batch_id]).wait()[0]
 
         if status['state'] == 'Failed':
             raise Exception("Batch failed: {0}".format(status['message']))
 
-        if status['state'] == 'Not processed':
+        if status['state'] == 'Not Processed':
             raise Exception("Batch will not be processed: {0}".format(status['message']))
 
         if status['processed'] == '0':
-            return ''
+            chunks = iter([])
+        else:
+            chunks = self._iter_batch_result(job_id, batch_id, max_workers)
+
+        if output is not None:
+            return self._write_chunks(chunks, output)
+        if stream:
+            return chunks if raw else self._iter_rows(chunks)
         # Retrieve and return data in CSV format
-        return self._get_batch_result(job_id, batch_id)
+        return b''.join(chunks).decode('utf-8')
+
+    def export_chunked(self, object_name, query=None, chunk_size=100000, max_workers=4,
+                       stream=False, raw=False, output=None):
+        """ Exports data of specified object using PK chunking
+            Query is split into batches of chunk_size records by Salesforce and results of
+            the batches are downloaded concurrently and merged into one CSV.
+            Accepts the same result options as export() """
+        if query is None:
+            query = "SELECT Id FROM {0}".format(object_name)
 
-    def upsert_object(self, object_name, csv_data, external_id_field):
-        return self.upsert(object_name, csv_data, external_id_field)
+        # Create async job with PK chunking enabled and add query batch
+        job_id = self._create_job('query', object_name, 'CSV', pk_chunk_size=chunk_size)
+        batch_id = self._add_batch(job_id, query)
 
-    def upsert(self, object_name, csv_data, external_id_field):
-        """ Upserts data to specified object
-            Records will be matched by external id field """
-        # Create async job and add query batch
-        job_id = self._create_job('upsert', object_name, 'CSV', external_id_field)
-        batch_id = self._add_batch(job_id, csv_data)
+        # Wait until all chunk batches are processed, start downloading results as soon as batches complete
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = []
+        monitor = self.monitor(job_id)
+        downloading = set()
+        is_closed = False
+
+        def check():
+            """ Updates batches' state and downloads results of completed ones, returns True when all are done """
+            nonlocal is_closed
+            monitor.poll()
+            original = monitor.get_batch(batch_id)
+            if original['state'] == 'Failed':
+                raise Exception("Batch failed: {0}".format(original['message']))
+            if original['state'] != 'Not Processed':
+                return False
+            # All chunk batches have been created at this point
+            if not is_closed:
+                self._close_job(job_id)
+                is_closed = True
+            chunks = [batch for batch in monitor.get_batches() if batch['id'] != batch_id]
+            for batch in chunks:
+                if batch['state'] in ['Failed', 'Not Processed']:
+                    raise Exception("Batch failed: {0}".format(batch['message']))
+                if batch['state'] == 'Completed' and batch['id'] not in downloading:
+                    downloading.add(batch['id'])
+                    if batch['processed'] != '0':
+                        # Batches are already downloaded concurrently, so results of each one are fetched in turn
+                        futures.append(executor.submit(self._spool_batch_result, job_id, batch['id'], 1))
+            return len(downloading) == len(chunks)
+
+        try:
+            self._poller.wait(check, lambda is_done: is_done)
+        except Exception:
+            self._discard_spooled_results(executor, futures)
+            raise
+
+        chunks = self._iter_spooled_results(executor, futures)
+        if output is not None:
+            return self._write_chunks(chunks, output)
+        if stream:
+            return chunks if raw else self._iter_rows(chunks)
+        # Retrieve and return data in CSV format
+        return b''.join(chunks).decode('utf-8')
+
+    def monitor(self, job_id, batch_ids=None):
+        """ Returns monitor tracking state of specified batches or of all job's batches """
+        return SfdcBulkJobMonitor(self, job_id, batch_ids)
+
+    def _load(self, operation, object_name, csv_data, external_id_field=None, max_workers=4):
+        """ Loads data to specified object using passed operation
+            Input is split into batches which are submitted to one job concurrently """
+        job_id = self._create_job(operation, object_name, 'CSV', external_id_field)
+
+        # Add batches, at most max_workers of them are held in memory and uploaded at once
+        batch_ids = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = []
+            for data in self._split_batches(csv_data):
+                if len(pending) >= max_workers:
+                    batch_ids.append(pending.pop(0).result())
+                pending.append(executor.submit(self._add_batch, job_id, data))
+            for future in pending:
+                batch_ids.append(future.result())
         self._close_job(job_id)
 
-        # Wait until batch is processed
-        status = self._get_batch_state(job_id, batch_id)
-        while status['state'] not in ['Completed', 'Failed', 'Not Processed']:
-            time.sleep(5)
-            status = self._get_batch_state(job_id, batch_id)
+        # Wait until batches are processed
+        status = self._aggregate_status(operation, self.monitor(job_id, batch_ids).wait())
 
-        if status['state'] != 'Completed':
-            raise Exception("Upsert call failed: {0}".format(status['message']))
-
-        if int(status['failed']) > 0:
-            status['results'] = self._get_batch_result(job_id, batch_id, True)
+        result_batch_ids = self._get_result_batch_ids(status)
+        if result_batch_ids:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                self._set_results(status, result_batch_ids, list(executor.map(
+                    lambda batch_id: self._get_batch_result(job_id, batch_id, True), result_batch_ids)))
 
+        self._check_status(status)
         return status
 
-    def update_object(self, object_name, csv_data):
-        return self.update(object_name, csv_data)
-
-    def update(self, object_name, csv_data):
-        """ Updates data in specified object
-            Records will be matched by id field """
-        # Create async job and add query batch
-        job_id = self._create_job('update', object_name, 'CSV')
-        batch_id = self._add_batch(job_id, csv_data)
-        self._close_job(job_id)
+    @staticmethod
+    def _aggregate_status(operation, batches):
+        """ Aggregates states of load operation's batches
+            State is Failed if any batch was not completed, records of other batches are loaded
+            nevertheless so states of all batches are kept under 'batches' in input order """
+        failed = [batch for batch in batches if batch['state'] != 'Completed']
+        return {
+            'state': 'Failed' if failed else 'Completed',
+            'message': '\n'.join(
+                "{0} call failed in batch {1}: {2}".format(operation.capitalize(), batch['id'], batch['message'])
+                for batch in failed) or None,
+            'processed': str(sum(int(batch['processed']) for batch in batches)),
+            'failed': str(sum(int(batch['failed']) for batch in batches)),
+            'batches': batches
+        }
 
-        # Wait until batch is processed
-        status = self._get_batch_state(job_id, batch_id)
-        while status['state'] not in ['Completed', 'Failed', 'Not Processed']:
-            time.sleep(5)
-            status = self._get_batch_state(job_id, batch_id)
+    @staticmethod
+    def _check_status(status):
+        """ Raises an exception if any batch failed, aggregated status along with results of completed
+            batches is attached to the exception as its status attribute """
+        if status['state'] != 'Completed':
+            error = Exception(status['message'])
+            error.status = status
+            raise error
 
+    @staticmethod
+    def _get_result_batch_ids(status):
+        """ Returns ids of batches whose results should be downloaded """
         if status['state'] != 'Completed':
-            raise Exception("Update call failed: {0}".format(status['message']))
+            return [batch['id'] for batch in status['batches'] if batch['state'] == 'Completed']
+        return [batch['id'] for batch in status['batches']] if int(status['failed']) > 0 else []
+
+    @staticmethod
+    def _set_results(status, batch_ids, results):
+        """ Adds results of batches to status
+            If all batches completed they are merged under 'results', otherwise results of completed
+            batches are put under 'batch_results' keyed by batch id as they do not cover all input rows """
+        if status['state'] == 'Completed':
+            status['results'] = SfdcBulkApi._merge_results(results)
+        else:
+            status['batch_results'] = dict(zip(batch_ids, results))
+
+    @staticmethod
+    def _merge_results(results):
+        """ Merges CSV results of batches keeping header of the first one only
+            Results are row aligned with input data so they must be passed in batches' order """
+        return results[0] + ''.join(result.split('\n', 1)[-1] for result in results[1:])
+
+    def upsert_object(self, object_name, csv_data, external_id_field, **kwargs):
+        return self.upsert(object_name, csv_data, external_id_field, **kwargs)
+
+    def upsert(self, object_name, csv_data, external_id_field, max_workers=4):
+        """ Upserts data to specified object
+            Records will be matched by external id field
+            csv_data can be a string, a file object or an iterable of rows (header first),
+            it is split into batches which are uploaded using up to max_workers concurrent requests """
+        return self._load('upsert', object_name, csv_data, external_id_field, max_workers)
 
-        if int(status['failed']) > 0:
-            status['results'] = self._get_batch_result(job_id, batch_id, True)
+    def update_object(self, object_name, csv_data, **kwargs):
+        return self.update(object_name, csv_data, **kwargs)
 
-        return status
+    def update(self, object_name, csv_data, max_workers=4):
+        """ Updates data in specified object
+            Records will be matched by id field
+            Accepts the same input as upsert() """
+        return self._load('update', object_name, csv_data, max_workers=max_workers)
 
-    def delete_object(self, object_name, csv_data):
-        return self.delete(object_name, csv_data)
+    def delete_object(self, object_name, csv_data, **kwargs):
+        return self.delete(object_name, csv_data, **kwargs)
 
-    def delete(self, object_name, csv_data):
+    def delete(self, object_name, csv_data, max_workers=4):
         """ Deleted data from specified object
-            Records will be matched by id field """
-        # Create async job and add query batch
-        job_id = self._create_job('delete', object_name, 'CSV')
-        batch_id = self._add_batch(job_id, csv_data)
-        self._close_job(job_id)
+            Records will be matched by id field
+            Accepts the same input as upsert() """
+        return self._load('delete', object_name, csv_data, max_workers=max_workers)
 
-        # Wait until batch is processed
-        status = self._get_batch_state(job_id, batch_id)
-        while status['state'] not in ['Completed', 'Failed', 'Not Processed']:
-            time.sleep(5)
-            status = self._get_batch_state(job_id, batch_id)
 
-        if status['state'] != 'Completed':
-            raise Exception("Delete call failed: {0}".format(status['message']))
+class SfdcBulkJobMonitor:
+    """ Tracks state of Bulk API job's batches
+        Batch list of the job is fetched once per poll and state of every tracked batch is updated from it """
+    _FINAL_STATES = ['Completed', 'Failed', 'Not Processed']
 
-        if int(status['failed']) > 0:
-            status['results'] = self._get_batch_result(job_id, batch_id, True)
+    def __init__(self, bulk, job_id, batch_ids=None):
+        self._bulk = bulk
+        self._job_id = job_id
+        self._track_all = batch_ids is None
+        self._batch_ids = list(batch_ids or [])
+        self._batches = {}
 
-        return status
+    def get_job_id(self):
+        return self._job_id
+
+    def poll(self):
+        """ Fetches state of all job's batches, returns aggregated progress """
+        batches = self._bulk._get_batches(self._job_id)
+        for batch in batches:
+            if batch['id'] not in self._batches and self._track_all:
+                self._batch_ids.append(batch['id'])
+            self._batches[batch['id']] = batch
+        for batch_id in self._batch_ids:
+            if batch_id not in self._batches:
+                raise Exception("Batch was not found")
+        return self.get_progress()
+
+    def get_batch(self, batch_id):
+        """ Returns last known state of the batch """
+        return self._batches[batch_id]
+
+    def get_batches(self):
+        """ Returns last known state of tracked batches in the order they were added """
+        return [self._batches[batch_id] for batch_id in self._batch_ids if batch_id in self._batches]
+
+    def is_done(self):
+        """ Returns True if all tracked batches have been processed """
+        batches = self.get_batches()
+        if self._track_all and not batches:
+            return False
+        return all(batch['state'] in self._FINAL_STATES for batch in batches)
+
+    def get_progress(self):
+        """ Returns aggregated progress of tracked batches """
+        batches = self.get_batches()
+        return {
+            'batches_total': len(batches),
+            'batches_done': len([batch for batch in batches if batch['state'] in self._FINAL_STATES]),
+            'batches_failed': len([batch for batch in batches if batch['state'] == 'Failed']),
+            'processed': sum(int(batch['processed']) for batch in batches),
+            'failed': sum(int(batch['failed']) for batch in batches)
+        }
+
+    def wait(self):
+        """ Polls until all tracked batches are processed, returns their states """
+        self._bulk.get_poller().wait(self.poll, lambda progress: self.is_done())
+        return self.get_batches()
@@ -0,0 +1,232 @@
+""" Class to work with Salesforce Bulk API 2.0 """
+import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sfdclib.bulk import SfdcBulkApi
+from sfdclib.poller import SfdcPoller
+from sfdclib.rest import SfdcRestApi
+
+
+class SfdcBulk2Api:
+    """ Class to work with Salesforce Bulk API 2.0
+        Requires API version 47.0 or higher """
+    _API_BASE_URI = "/services/data/v{version}/jobs"
+    _FINAL_STATES = ['JobComplete', 'Failed', 'Aborted']
+    _DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+    _MIN_VERSION = 47.0
+
+    def __init__(self, session, poller=None):
+        if not session.is_connected():
+            raise Exception("Session must be connected prior to instantiating this class")
+        SfdcRestApi._check_api_version(session, "Bulk API 2.0", self._MIN_VERSION)
+        self._session = session
+        self._poller = poller if poller is not None else SfdcPoller()
+
+    def _get_api_uri(self):
+        """ Returns Bulk API 2.0 base URI for this connection """
+        return self._API_BASE_URI.format(**{'version': self._session.get_api_version()})
+
+    def _get_headers(self, content_type='application/json'):
+        """ Compose HTTP header for request """
+        return {
+            'Authorization': 'Bearer %s' % self._session.get_session_id(),
+            'Accept-Encoding': 'gzip',
+            'Accept': 'application/json',
+            'Content-Type': "{0}; charset=UTF-8".format(content_type)
+        }
+
+    def _request(self, method, uri, expected_status, **kwargs):
+        """ Sends request to Bulk API 2.0 and checks response status """
+        url = self._session.construct_url(self._get_api_uri() + uri)
+        res = self._session.request(method, url, **kwargs)
+        if res.status_code != expected_status:
+            raise Exception(
+                "Request failed with %d code and error [%s]" %
+                (res.status_code, res.text))
+        return res
+
+    def _create_job(self, kind, request):
+        """ Create ingest or query job """
+        res = self._request('POST', "/{0}".format(kind), 200, headers=self._get_headers(), json=request)
+        return json.loads(res.text)['id']
+
+    def _upload_job_data(self, job_id, csv_data):
+        """ Uploads CSV data to ingest job
+            csv_data can be a string, bytes, a file object or an iterable of byte chunks,
+            anything but a string is streamed to Salesforce """
+        if isinstance(csv_data, str):
+            csv_data = csv_data.encode('utf-8')
+        self._request(
+            'PUT', "/ingest/{0}/batches".format(job_id), 201,
+            headers=self._get_headers('text/csv'), data=csv_data)
+
+    def _set_job_state(self, kind, job_id, state):
+        """ Changes job's state """
+        self._request(
+            'PATCH', "/{0}/{1}".format(kind, job_id), 200, headers=self._get_headers(), json={'state': state})
+
+    def get_job(self, kind, job_id):
+        """ Returns information about ingest or query job """
+        res = self._request('GET', "/{0}/{1}".format(kind, job_id), 200, headers=self._get_headers())
+        return json.loads(res.text)
+
+    def abort_job(self, kind, job_id):
+        """ Aborts ingest or query job """
+        self._set_job_state(kind, job_id, 'Aborted')
+
+    def _wait_for_job(self, kind, job_id):
+        """ Waits until job is processed, returns job information """
+        job = self._poller.wait(
+            lambda: self.get_job(kind, job_id),
+            lambda info: info['state'] in self._FINAL_STATES)
+        if job['state'] != 'JobComplete':
+            raise Exception("Job {0}: {1}".format(job['state'].lower(), job.get('errorMessage')))
+        return job
+
+    def get_ingest_results(self, job_id, result_type='failedResults', output=None):
+        """ Returns successfulResults, failedResults or unprocessedrecords of ingest job as CSV
+            If output (file name or binary file object) is passed CSV is written to it
+            and number of bytes written is returned """
+        chunks = self._iter_response(self._request(
+            'GET', "/ingest/{0}/{1}/".format(job_id, result_type), 200,
+            headers=self._get_headers('text/csv'), stream=True))
+        if output is not None:
+            return SfdcBulkApi._write_chunks(chunks, output)
+        return b''.join(chunks).decode('utf-8')
+
+    def ingest(self, operation, object_name, csv_data, external_id_field=None):
+        """ Loads data to specified object using passed operation (insert, update, upsert, delete or hardDelete)
+            Returns job information, CSV of failed records is added under 'results' if there are any """
+        request = {
+            'object': object_name,
+            'operation': operation,
+            'contentType': 'CSV',
+            'lineEnding': 'LF'
+        }
+        if operation == 'upsert' and external_id_field is not None:
+            request['externalIdFieldName'] = external_id_field
+
+        job_id = self._create_job('ingest', request)
+        try:
+            self._upload_job_data(job_id, csv_data)
+        except Exception:
+            self.abort_job('ingest', job_id)
+            raise
+        self._set_job_state('ingest', job_id, 'UploadComplete')
+
+        job = self._wait_for_job('ingest', job_id)
+        if job.get('numberRecordsFailed', 0) > 0:
+            job['results'] = self.get_ingest_results(job_id)
+        return job
+
+    def insert(self, object_name, csv_data):
+        """ Inserts data to specified object """
+        return self.ingest('insert', object_name, csv_data)
+
+    def upsert(self, object_name, csv_data, external_id_field):
+        """ Upserts data to specified object
+            Records will be matched by external id field """
+        return self.ingest('upsert', object_name, csv_data, external_id_field)
+
+    def update(self, object_name, csv_data):
+        """ Updates data in specified object
+            Records will be matched by id field """
+        return self.ingest('update', object_name, csv_data)
+
+    def delete(self, object_name, csv_data):
+        """ Deletes data from specified object
+            Records will be matched by id field """
+        return self.ingest('delete', object_name, csv_data)
+
+    def _iter_response(self, res):
+        """ Yields body of streamed response as byte chunks """
+        try:
+            for chunk in res.iter_content(self._DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+        finally:
+            res.close()
+
+    def _iter_query_result(self, job_id, max_records, max_workers):
+        """ Yields query result as raw CSV byte chunks
+            Next page is requested as soon as locator of the current one is known so pages are
+            downloaded concurrently, at most max_workers pages are held in temporary files at once """
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        slots = threading.Semaphore(max_workers)
+        cancelled = threading.Event()
+
+        def fetch(locator):
+            """ Downloads page into temporary file, returns it along with future of the next page """
+            while not slots.acquire(timeout=0.1):
+                if cancelled.is_set():
+                    return None, None
+            params = {}
+            if locator is not None:
+                params['locator'] = locator
+            if max_records is not None:
+                params['maxRecords'] = max_records
+            res = self._request(
+                'GET', "/query/{0}/results".format(job_id), 200,
+                headers=self._get_headers('text/csv'), params=params, stream=True)
+            next_page = None
+            next_locator = res.headers.get('Sforce-Locator')
+            if next_locator and next_locator != 'null' and not cancelled.is_set():
+                next_page = executor.submit(fetch, next_locator)
+            file = tempfile.TemporaryFile()
+            try:
+                SfdcBulkApi._write_chunks(self._iter_response(res), file)
+            except Exception:
+                file.close()
+                raise
+            file.seek(0)
+            return file, next_page
+
+        page = executor.submit(fetch, None)
+        try:
+            is_first = True
+            while page is not None:
+                file, page = page.result()
+                try:
+                    if not is_first:
+                        file.readline()
+                    is_first = False
+                    chunk = file.read(self._DOWNLOAD_CHUNK_SIZE)
+                    while chunk:
+                        yield chunk
+                        chunk = file.read(self._DOWNLOAD_CHUNK_SIZE)
+                finally:
+                    file.close()
+                    slots.release()
+        finally:
+            cancelled.set()
+            while page is not None:
+                try:
+                    file, page = page.result()
+                except Exception:
+                    break
+                if file is not None:
+                    file.close()
+            executor.shutdown(wait=True)
+
+    def query(self, query, query_all=False, stream=False, raw=False, output=None, max_records=None, max_workers=4):
+        """ Runs SOQL query using query job
+            If query_all is True deleted and archived records are returned as well
+            Result pages are downloaded using up to max_workers concurrent requests
+            If stream is True a generator of CSV rows (or raw byte chunks if raw is True) is returned
+            If output (file name or binary file object) is passed CSV is written to it
+            and number of bytes written is returned """
+        job_id = self._create_job('query', {
+            'operation': 'queryAll' if query_all else 'query',
+            'query': query,
+            'contentType': 'CSV',
+            'lineEnding': 'LF'
+        })
+        self._wait_for_job('query', job_id)
+
+        chunks = self._iter_query_result(job_id, max_records, max_workers)
+        if output is not None:
+            return SfdcBulkApi._write_chunks(chunks, output)
+        if stream:
+            return chunks if raw else SfdcBulkApi._iter_rows(chunks)
+        return b''.join(chunks).decode('utf-8')
@@ -0,0 +1,320 @@
+""" Persistent caches of Salesforce data """
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def _write_json(path, data):
+    """ Atomically replaces file with JSON representation of data """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as file:
+            json.dump(data, file, sort_keys=True)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def _get_org_key(session):
+    """ Returns name identifying org of the session which is safe to use in file names """
+    org = session.get_org_id() or session.get_server_url()
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', org)
+
+
+class SfdcMetadataCache:
+    """ On-disk cache of metadata description, components listed by listMetadata
+        and content hashes of components deployed by deploy_delta()
+        One JSON file is kept per org and API version, components are compared
+        by lastModifiedDate to find out what changed since they were cached """
+
+    def __init__(self, directory, session):
+        self._path = os.path.join(directory, "metadata_{0}_{1}.json".format(
+            _get_org_key(session), session.get_api_version()))
+        self._lock = threading.Lock()
+        if os.path.isfile(self._path):
+            with open(self._path) as file:
+                self._data = json.load(file)
+        else:
+            self._data = {'describe': None, 'components': {}}
+
+    def get_path(self):
+        return self._path
+
+    def get_describe(self):
+        """ Returns cached result of describeMetadata or None """
+        return self._data['describe']
+
+    def set_describe(self, describe):
+        with self._lock:
+            self._data['describe'] = describe
+
+    def get_types(self):
+        """ Returns names of metadata types having cached components """
+        return list(self._data['components'])
+
+    def get_components(self, metadata_type):
+        """ Returns cached components of the type keyed by full name or None if type is not cached """
+        return self._data['components'].get(metadata_type)
+
+    def diff_components(self, metadata_type, components):
+        """ Compares listed components of the type with cached ones
+            Returns dict of added, changed and removed components """
+        cached = self.get_components(metadata_type) or {}
+        listed = dict((component['full_name'], component) for component in components)
+        return {
+            'added': [listed[name] for name in listed if name not in cached],
+            'changed': [listed[name] for name in listed if name in cached and
+                        listed[name].get('last_modified_date') != cached[name].get('last_modified_date')],
+            'removed': [cached[name] for name in cached if name not in listed]
+        }
+
+    def set_components(self, metadata_type, components):
+        """ Replaces cached components of the type """
+        with self._lock:
+            self._data['components'][metadata_type] = dict(
+                (component['full_name'], component) for component in components)
+
+    def remove_components(self, metadata_type):
+        with self._lock:
+            self._data['components'].pop(metadata_type, None)
+
+    def get_deployed(self):
+        """ Returns content hashes of components deployed last time keyed by type and full name """
+        return self._data.get('deployed', {})
+
+    def set_deployed(self, deployed):
+        with self._lock:
+            self._data['deployed'] = deployed
+
+    def save(self):
+        """ Writes cache to disk """
+        with self._lock:
+            _write_json(self._path, self._data)
+
+
+class SfdcMemoryTokenCache:
+    """ Session token cache kept in memory, can stand in for SfdcFileTokenCache in tests
+        Tokens older than max_age seconds are not returned """
+
+    def __init__(self, max_age=None):
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def _load(self):
+        return self._tokens
+
+    def _store(self, tokens):
+        self._tokens = tokens
+
+    def get(self, key):
+        """ Returns token stored under key or None if there is no valid one """
+        with self._lock:
+            token = self._load().get(key)
+        if token is None:
+            return None
+        if self._max_age is not None and time.time() - token.get('created', 0) > self._max_age:
+            return None
+        return token
+
+    def set(self, key, token):
+        with self._lock:
+            tokens = self._load()
+            tokens[key] = token
+            self._store(tokens)
+
+    def delete(self, key):
+        with self._lock:
+            tokens = self._load()
+            if tokens.pop(key, None) is not None:
+                self._store(tokens)
+
+
+class SfdcFileTokenCache(SfdcMemoryTokenCache):
+    """ Session token cache kept in JSON file so it can be shared by processes
+        File is readable by its owner only as it contains session ids """
+
+    def __init__(self, path, max_age=None):
+        super(SfdcFileTokenCache, self).__init__(max_age)
+        self._path = path
+
+    def get_path(self):
+        return self._path
+
+    def _load(self):
+        if not os.path.isfile(self._path):
+            return {}
+        try:
+            with open(self._path) as file:
+                return json.load(file)
+        except ValueError:
+            return {}
+
+    def _store(self, tokens):
+        _write_json(self._path, tokens)
+
+
+class SfdcMemoryQueryCache:
+    """ SOQL query result cache kept in memory, shared by SfdcRestApi and SfdcToolingApi when passed
+        to SfdcSession as query_cache. Results are keyed by normalized query, API kind, API version and org,
+        expire after ttl seconds and the least recently used ones are evicted above max_size entries """
+    _LITERAL = re.compile(r"('(?:\\.|[^'\\])*')")
+    _WHITESPACE = re.compile(r'\s+')
+
+    def __init__(self, max_size=1000, ttl=300):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # Key to expiration time in order of use, the least recently used first
+        self._entries = OrderedDict()
+        self._results = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @classmethod
+    def normalize_query(cls, query):
+        """ Collapses whitespace outside of string literals """
+        parts = cls._LITERAL.split(query.strip())
+        return ''.join(part if i % 2 else cls._WHITESPACE.sub(' ', part) for i, part in enumerate(parts))
+
+    def get_key(self, session, api, query):
+        """ Returns cache key of query sent to API (rest or tooling) by session """
+        return "{0}|{1}|{2}|{3}".format(
+            api, _get_org_key(session), session.get_api_version(), self.normalize_query(query))
+
+    def _read(self, key):
+        return json.loads(self._results[key])
+
+    def _write(self, key, result, expires):
+        # Kept serialized so callers can not modify cached result
+        self._results[key] = json.dumps(result)
+
+    def _remove(self, key):
+        self._results.pop(key, None)
+
+    def get(self, key):
+        """ Returns cached result or None if there is no valid one """
+        with self._lock:
+            expires = self._entries.get(key)
+            result = None
+            if expires is not None:
+                result = self._read(key) if expires > time.time() else None
+                if result is None:
+                    del self._entries[key]
+                    self._remove(key)
+            if result is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return result
+
+    def set(self, key, result, ttl=None):
+        """ Caches result for ttl seconds, cache's ttl is used if it is None """
+        expires = time.time() + (self._ttl if ttl is None else ttl)
+        with self._lock:
+            self._write(key, result, expires)
+            self._entries[key] = expires
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._remove(evicted)
+                self._evictions += 1
+
+    def fetch(self, session, api, query, func, ttl=None):
+        """ Returns cached result of query or result of func() which is cached if it is complete
+            ttl overrides cache's ttl, 0 bypasses the cache """
+        if ttl == 0:
+            return func()
+        key = self.get_key(session, api, query)
+        result = self.get(key)
+        if result is None:
+            result = func()
+            # Query locators of further pages expire so only complete results are cached
+            if result.get('done', True):
+                self.set(key, result, ttl)
+        return result
+
+    def delete(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in self._entries:
+                self._remove(key)
+            self._entries.clear()
+
+    def get_stats(self):
+        """ Returns hit, miss and eviction counters along with number of cached results """
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'size': len(self._entries)
+            }
+
+
+class SfdcFileQueryCache(SfdcMemoryQueryCache):
+    """ SOQL query result cache keeping one JSON file per result in a directory so results survive restarts
+        Files left by previous runs are picked up in order of their modification time """
+
+    def __init__(self, directory, max_size=1000, ttl=300):
+        super(SfdcFileQueryCache, self).__init__(max_size, ttl)
+        self._directory = directory
+        if os.path.isdir(directory):
+            self._load_entries()
+
+    def get_directory(self):
+        return self._directory
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, "query_{0}.json".format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def _load_entries(self):
+        """ Indexes valid results stored in directory """
+        paths = [os.path.join(self._directory, name) for name in os.listdir(self._directory)
+                 if name.startswith('query_') and name.endswith('.json')]
+        now = time.time()
+        for path in sorted(paths, key=os.path.getmtime):
+            try:
+                with open(path) as file:
+                    entry = json.load(file)
+            except ValueError:
+                continue
+            if entry['expires'] > now:
+                self._entries[entry['key']] = entry['expires']
+            else:
+                os.remove(path)
+        while len(self._entries) > self._max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            self._remove(evicted)
+
+    def _read(self, key):
+        try:
+            with open(self._get_path(key)) as file:
+                return json.load(file)['result']
+        except (OSError, ValueError):
+            # Removed or being replaced by another process
+            return None
+
+    def _write(self, key, result, expires):
+        _write_json(self._get_path(key), {'key': key, 'expires': expires, 'result': result})
+
+    def _remove(self, key):
+        try:
+            os.remove(self._get_path(key))
+        except OSError:
+            pass
@@ -0,0 +1,238 @@
+""" Streaming parser of Apex debug logs """
+import io
+import re
+from array import array
+
+
+class ApexLogEvent:
+    """ Event of Apex debug log
+        start and end are nanoseconds elapsed since the log started, end is None for events
+        which did not finish within the log. offset is byte offset of the line the event starts at """
+    __slots__ = ('type', 'offset', 'line', 'start', 'end', 'data')
+
+    def __init__(self, event_type, offset, line, start, data):
+        self.type = event_type
+        self.offset = offset
+        self.line = line
+        self.start = start
+        self.end = None
+        self.data = data
+
+    @property
+    def duration(self):
+        """ Returns duration in nanoseconds or None if event did not finish """
+        return self.end - self.start if self.end is not None else None
+
+    def __repr__(self):
+        return "ApexLogEvent(%s, line=%s, start=%s, end=%s, %r)" % (
+            self.type, self.line, self.start, self.end, self.data)
+
+
+class SfdcApexLogIndex:
+    """ Compact index of Apex debug log
+        Keeps byte offsets of events by type together with SOQL/DML counts, rows and durations """
+
+    def __init__(self):
+        self._offsets = {}
+        self._durations = {}
+        self._soql_rows = 0
+        self._dml_rows = 0
+        self._limits = {}
+
+    def _add(self, event):
+        self._offsets.setdefault(event.type, array('q')).append(event.offset)
+        if event.end is not None:
+            self._durations[event.type] = self._durations.get(event.type, 0) + event.duration
+        if event.type == 'SOQL_EXECUTE':
+            self._soql_rows += event.data.get('rows') or 0
+        elif event.type == 'DML':
+            self._dml_rows += event.data.get('rows') or 0
+        elif event.type == 'LIMIT_USAGE' and event.data.get('namespace') is not None:
+            self._limits[event.data['namespace']] = event.data['limits']
+
+    def get_types(self):
+        return list(self._offsets)
+
+    def get_count(self, event_type):
+        return len(self._offsets.get(event_type, ()))
+
+    def get_offsets(self, event_type):
+        """ Returns byte offsets of events of the type in order they start """
+        return sorted(self._offsets.get(event_type, ()))
+
+    def get_aggregates(self):
+        """ Returns SOQL and DML counts, rows and total durations in nanoseconds along with the last limit usage """
+        return {
+            'soql_count': self.get_count('SOQL_EXECUTE'),
+            'soql_rows': self._soql_rows,
+            'soql_duration': self._durations.get('SOQL_EXECUTE', 0),
+            'dml_count': self.get_count('DML'),
+            'dml_rows': self._dml_rows,
+            'dml_duration': self._durations.get('DML', 0),
+            'user_debug_count': self.get_count('USER_DEBUG'),
+            'code_unit_count': self.get_count('CODE_UNIT'),
+            'limits': self._limits
+        }
+
+
+class SfdcApexLogParser:
+    """ Turns Apex debug log into SOQL_EXECUTE, DML, LIMIT_USAGE, USER_DEBUG and CODE_UNIT events
+        Log is read line by line so memory use does not depend on its size """
+    EVENT_TYPES = ['SOQL_EXECUTE', 'DML', 'LIMIT_USAGE', 'USER_DEBUG', 'CODE_UNIT']
+    _BEGIN = {
+        b'SOQL_EXECUTE_BEGIN': 'SOQL_EXECUTE',
+        b'DML_BEGIN': 'DML',
+        b'CODE_UNIT_STARTED': 'CODE_UNIT'
+    }
+    _END = {
+        b'SOQL_EXECUTE_END': 'SOQL_EXECUTE',
+        b'DML_END': 'DML',
+        b'CODE_UNIT_FINISHED': 'CODE_UNIT'
+    }
+    _NAMES = frozenset(list(_BEGIN) + list(_END) + [b'USER_DEBUG', b'LIMIT_USAGE', b'LIMIT_USAGE_FOR_NS'])
+    _LIMIT = re.compile(r'\s*(.+?): (\d+) out of (\d+)')
+
+    def __init__(self, types=None):
+        self._types = set(types if types is not None else self.EVENT_TYPES)
+
+    @staticmethod
+    def _iter_lines(source, offset=0):
+        """ Yields byte offset and line as bytes
+            Source is a file name, a file object or an iterable of lines (str or bytes) """
+        if isinstance(source, str):
+            with open(source, 'rb') as file:
+                file.seek(offset)
+                for line in file:
+                    yield offset, line
+                    offset += len(line)
+            return
+        if isinstance(source, io.TextIOBase):
+            source = (line.encode('utf-8') for line in source)
+        for line in source:
+            if isinstance(line, str):
+                line = line.encode('utf-8')
+            yield offset, line
+            offset += len(line)
+
+    @staticmethod
+    def _get_line_number(field):
+        """ Parses [123] Apex line number field """
+        if field.startswith(b'[') and field.endswith(b']') and field[1:-1].isdigit():
+            return int(field[1:-1])
+        return None
+
+    @staticmethod
+    def _get_value(field, name):
+        """ Parses Name:value field returning integer value """
+        if field.startswith(name):
+            value = field[len(name):]
+            if value.isdigit():
+                return int(value)
+        return None
+
+    def _start_event(self, event_type, offset, start, fields):
+        """ Creates event from fields of its first line """
+        line = self._get_line_number(fields[0]) if fields else None
+        data = {}
+        if event_type == 'SOQL_EXECUTE':
+            data['aggregations'] = self._get_value(fields[1], b'Aggregations:') if len(fields) > 1 else None
+            data['query'] = b'|'.join(fields[2:]).decode('utf-8', 'replace') if len(fields) > 2 else None
+            data['rows'] = None
+        elif event_type == 'DML':
+            for field in fields[1:]:
+                if field.startswith(b'Op:'):
+                    data['operation'] = field[3:].decode('utf-8', 'replace')
+                elif field.startswith(b'Type:'):
+                    data['object'] = field[5:].decode('utf-8', 'replace')
+                elif field.startswith(b'Rows:'):
+                    data['rows'] = self._get_value(field, b'Rows:')
+        elif event_type == 'CODE_UNIT':
+            data['name'] = fields[-1].decode('utf-8', 'replace') if fields else None
+        elif event_type == 'USER_DEBUG':
+            data['level'] = fields[1].decode('utf-8', 'replace') if len(fields) > 1 else None
+            data['message'] = b'|'.join(fields[2:]).decode('utf-8', 'replace')
+        elif event_type == 'LIMIT_USAGE':
+            data['namespace'] = None
+            data['limits'] = {}
+            if line is None:
+                # LIMIT_USAGE_FOR_NS|(default)| followed by one limit per line
+                data['namespace'] = fields[0].decode('utf-8', 'replace') if fields else ''
+            elif len(fields) >= 4 and fields[2].isdigit() and fields[3].isdigit():
+                # LIMIT_USAGE|[line]|SOQL|1|100
+                data['limits'][fields[1].decode('utf-8', 'replace')] = (int(fields[2]), int(fields[3]))
+        return ApexLogEvent(event_type, offset, line, start, data)
+
+    @staticmethod
+    def _continue_event(event, line):
+        """ Adds line which does not start with timestamp to the preceding event """
+        if event.type == 'USER_DEBUG':
+            event.data['message'] += '\n' + line.decode('utf-8', 'replace')
+        elif event.type == 'LIMIT_USAGE' and event.data['namespace'] is not None:
+            limit = SfdcApexLogParser._LIMIT.match(line.decode('utf-8', 'replace'))
+            if limit:
+                event.data['limits'][limit.group(1)] = (int(limit.group(2)), int(limit.group(3)))
+
+    def iter_events(self, source, offset=0):
+        """ Yields events of log read from source (file name, file object or iterable of lines)
+            starting at byte offset. Events having begin and end lines are yielded when they end """
+        open_events = {}
+        pending = None
+        for line_offset, line in self._iter_lines(source, offset):
+            line = line.rstrip(b'\r\n')
+            # Cheap check of "HH:MM:SS.s (nanos)|EVENT|fields" shape, other lines continue the previous event
+            head, separator, rest = line.partition(b'|')
+            if not separator or head[2:3] != b':' or not head.endswith(b')'):
+                if pending is not None:
+                    self._continue_event(pending, line)
+                continue
+            if pending is not None:
+                yield pending
+                pending = None
+
+            name, separator, rest = rest.partition(b'|')
+            if name not in self._NAMES:
+                continue
+            last_time = int(head[head.rindex(b'(') + 1:-1])
+            fields = rest.split(b'|') if separator else []
+            if name in self._BEGIN:
+                event_type = self._BEGIN[name]
+                if event_type in self._types:
+                    open_events.setdefault(event_type, []).append(
+                        self._start_event(event_type, line_offset, last_time, fields))
+            elif name in self._END:
+                event_type = self._END[name]
+                stack = open_events.get(event_type)
+                if stack:
+                    event = stack.pop()
+                    event.end = last_time
+                    if event_type == 'SOQL_EXECUTE' and len(fields) > 1:
+                        event.data['rows'] = self._get_value(fields[1], b'Rows:')
+                    yield event
+            elif name == b'USER_DEBUG':
+                if 'USER_DEBUG' in self._types:
+                    pending = self._start_event('USER_DEBUG', line_offset, last_time, fields)
+            elif name in (b'LIMIT_USAGE', b'LIMIT_USAGE_FOR_NS'):
+                if 'LIMIT_USAGE' in self._types:
+                    pending = self._start_event('LIMIT_USAGE', line_offset, last_time, fields)
+
+        if pending is not None:
+            yield pending
+        # Events which did not end within the log (e.g. log was truncated)
+        for stack in open_events.values():
+            for event in stack:
+                yield event
+
+    def build_index(self, source):
+        """ Reads whole log once and returns SfdcApexLogIndex """
+        index = SfdcApexLogIndex()
+        for event in self.iter_events(source):
+            index._add(event)
+        return index
+
+    def read_event(self, path, event_type, offset):
+        """ Reads event of the type starting at byte offset of log file without reading the log from its start """
+        parser = SfdcApexLogParser([event_type])
+        for event in parser.iter_events(path, offset):
+            if event.offset == offset:
+                return event
+        return None
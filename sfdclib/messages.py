@@ -92,3 +92,42 @@ xmlns:met="http://soap.sforce.com/2006/04/metadata">
       </met:checkRetrieveStatus>
    </soapenv:Body>
 </soapenv:Envelope>"""
+
+DESCRIBE_METADATA_MSG = \
+    """<soapenv:Envelope
+xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+xmlns:met="http://soap.sforce.com/2006/04/metadata">
+   <soapenv:Header>
+      <met:CallOptions>
+         <met:client>{client}</met:client>
+      </met:CallOptions>
+      <met:SessionHeader>
+         <met:sessionId>{sessionId}</met:sessionId>
+      </met:SessionHeader>
+   </soapenv:Header>
+   <soapenv:Body>
+      <met:describeMetadata>
+         <met:asOfVersion>{asOfVersion}</met:asOfVersion>
+      </met:describeMetadata>
+   </soapenv:Body>
+</soapenv:Envelope>"""
+
+LIST_METADATA_MSG = \
+    """<soapenv:Envelope
+xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+xmlns:met="http://soap.sforce.com/2006/04/metadata">
+   <soapenv:Header>
+      <met:CallOptions>
+         <met:client>{client}</met:client>
+      </met:CallOptions>
+      <met:SessionHeader>
+         <met:sessionId>{sessionId}</met:sessionId>
+      </met:SessionHeader>
+   </soapenv:Header>
+   <soapenv:Body>
+      <met:listMetadata>
+         {queries}
+         <met:asOfVersion>{asOfVersion}</met:asOfVersion>
+      </met:listMetadata>
+   </soapenv:Body>
+</soapenv:Envelope>"""
@@ -1,8 +1,22 @@
 """ Class to work with Salesforce Metadata API """
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import zipfile as zip_archive
 from base64 import b64encode, b64decode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree as ET
+from xml.parsers import expat
+from xml.sax.saxutils import escape
 
 import sfdclib.messages as msg
+from sfdclib.cache import SfdcMetadataCache
+from sfdclib.parsers import parse_async_result, parse_deploy_result, parse_describe_metadata, parse_list_metadata, \
+    parse_result, parse_retrieve_result
+from sfdclib.poller import SfdcPoller
 
 
 class SfdcMetadataApi:
@@ -12,20 +26,48 @@ class SfdcMetadataApi:
         'soapenv': 'http://schemas.xmlsoap.org/soap/envelope/',
         'mt': 'http://soap.sforce.com/2006/04/metadata'
     }
-
-    def __init__(self, session):
+    _LIST_METADATA_QUERIES_PER_CALL = 3
+    _DEPLOY_FINAL_STATES = ['Succeeded', 'SucceededPartial', 'Failed', 'Canceled']
+    _RETRIEVE_FINAL_STATES = ['Succeeded', 'Failed']
+    # Types whose content depends on other components of the same retrieve
+    _DEPENDENT_TYPES = ['Profile', 'PermissionSet', 'MutingPermissionSet', 'Translations', 'CustomObjectTranslation']
+    _MERGED_SUFFIXES = ('.profile', '.permissionset', '.mutingpermissionset', '.translation', '.objectTranslation')
+
+    def __init__(self, session, poller=None):
         if not session.is_connected():
             raise Exception("Session must be connected prior to instantiating this class")
         self._session = session
         self._deploy_zip = None
+        self._poller = poller if poller is not None else SfdcPoller()
 
     def _get_api_url(self):
         return "%s%s" % (
             self._session.get_server_url(),
             self._METADATA_API_BASE_URI.format(**{'version': self._session.get_api_version()}))
 
-    def deploy(self, zipfile, options):
-        """ Kicks off async deployment, returns deployment id """
+    def deploy(self, zipfile, options, stream=False):
+        """ Kicks off async deployment, returns deployment id
+            If stream is True ZIP file is base64 encoded in chunks while request is being sent """
+        attributes = self._get_deploy_attributes(self._session, options)
+        if stream:
+            prefix, suffix = msg.DEPLOY_MSG.split('{ZipFile}')
+            request = _DeployRequestBody(prefix.format(**attributes), zipfile, suffix.format(**attributes))
+        else:
+            attributes['ZipFile'] = self._read_deploy_zip(zipfile)
+            request = msg.DEPLOY_MSG.format(**attributes)
+
+        headers = {'Content-type': 'text/xml', 'SOAPAction': 'deploy'}
+        res = self._session.post(self._get_api_url(), headers=headers, data=request)
+        if res.status_code != 200:
+            raise Exception(
+                "Request failed with %d code and error [%s]" %
+                (res.status_code, res.text))
+
+        return parse_async_result(res.content, 'deployResponse')
+
+    @staticmethod
+    def _get_deploy_attributes(session, options):
+        """ Composes deploy request attributes except for ZIP file """
         check_only = ""
         if 'checkonly' in options:
             check_only = "<met:checkOnly>%s</met:checkOnly>" % options['checkonly']
@@ -39,33 +81,14 @@ class SfdcMetadataApi:
             for test in options['tests']:
                 tests_tag += "<met:runTests>%s</met:runTests>\n" % test
 
-        attributes = {
+        return {
             'client': 'Metahelper',
             'checkOnly': check_only,
-            'sessionId': self._session.get_session_id(),
-            'ZipFile': self._read_deploy_zip(zipfile),
+            'sessionId': session.get_session_id(),
             'testLevel': test_level,
             'tests': tests_tag
         }
 
-        request = msg.DEPLOY_MSG.format(**attributes)
-
-        headers = {'Content-type': 'text/xml', 'SOAPAction': 'deploy'}
-        res = self._session.post(self._get_api_url(), headers=headers, data=request)
-        if res.status_code != 200:
-            raise Exception(
-                "Request failed with %d code and error [%s]" %
-                (res.status_code, res.text))
-
-        async_process_id = ET.fromstring(res.text).find(
-            'soapenv:Body/mt:deployResponse/mt:result/mt:id',
-            self._XML_NAMESPACES).text
-        state = ET.fromstring(res.text).find(
-            'soapenv:Body/mt:deployResponse/mt:result/mt:state',
-            self._XML_NAMESPACES).text
-
-        return async_process_id, state
-
     @staticmethod
     def _read_deploy_zip(zipfile):
         if hasattr(zipfile, 'read'):
@@ -80,80 +103,81 @@ class SfdcMetadataApi:
             file.close()
         return b64encode(raw).decode("utf-8")
 
-    def _retrieve_deploy_result(self, async_process_id):
-        """ Retrieves status for specified deployment id """
+    def _request_deploy_result(self, async_process_id, include_details):
+        """ Sends checkDeployStatus request
+            Component and test results are included only if include_details is True """
         attributes = {
             'client': 'Metahelper',
             'sessionId': self._session.get_session_id(),
             'asyncProcessId': async_process_id,
-            'includeDetails': 'true'
+            'includeDetails': 'true' if include_details else 'false'
             }
         mt_request = msg.CHECK_DEPLOY_STATUS_MSG.format(**attributes)
         headers = {'Content-type': 'text/xml', 'SOAPAction': 'checkDeployStatus'}
-        res = self._session.post(self._get_api_url(), headers=headers, data=mt_request)
-        root = ET.fromstring(res.text)
-        result = root.find(
-            'soapenv:Body/mt:checkDeployStatusResponse/mt:result',
-            self._XML_NAMESPACES)
-        if result is None:
-            raise Exception("Result node could not be found: %s" % res.text)
+        return self._session.post(self._get_api_url(), headers=headers, data=mt_request)
 
-        return result
+    def _retrieve_deploy_result(self, async_process_id, include_details=True):
+        """ Retrieves status for specified deployment id as DeployResult """
+        return parse_deploy_result(self._request_deploy_result(async_process_id, include_details).content)
 
     def check_deploy_status(self, async_process_id):
         """ Checks whether deployment succeeded """
-        result = self._retrieve_deploy_result(async_process_id)
-        state = result.find('mt:status', self._XML_NAMESPACES).text
-        state_detail = result.find('mt:stateDetail', self._XML_NAMESPACES)
-        if state_detail is not None:
-            state_detail = state_detail.text
-
-        unit_test_errors = []
-        deployment_errors = []
-        if state == 'Failed':
-            # Deployment failures
-            failures = result.findall('mt:details/mt:componentFailures', self._XML_NAMESPACES)
-            for failure in failures:
-                deployment_errors.append({
-                    'type': failure.find('mt:componentType', self._XML_NAMESPACES).text,
-                    'file': failure.find('mt:fileName', self._XML_NAMESPACES).text,
-                    'status': failure.find('mt:problemType', self._XML_NAMESPACES).text,
-                    'message': failure.find('mt:problem', self._XML_NAMESPACES).text
-                    })
-            # Unit test failures
-            failures = result.findall(
-                'mt:details/mt:runTestResult/mt:failures',
-                self._XML_NAMESPACES)
-            for failure in failures:
-                unit_test_errors.append({
-                    'class': failure.find('mt:name', self._XML_NAMESPACES).text,
-                    'method': failure.find('mt:methodName', self._XML_NAMESPACES).text,
-                    'message': failure.find('mt:message', self._XML_NAMESPACES).text,
-                    'stack_trace': failure.find('mt:stackTrace', self._XML_NAMESPACES).text
-                    })
-
-        deployment_detail = {
-            'total_count': result.find('mt:numberComponentsTotal', self._XML_NAMESPACES).text,
-            'failed_count': result.find('mt:numberComponentErrors', self._XML_NAMESPACES).text,
-            'deployed_count': result.find('mt:numberComponentsDeployed', self._XML_NAMESPACES).text,
-            'errors': deployment_errors
-        }
-        unit_test_detail = {
-            'total_count': result.find('mt:numberTestsTotal', self._XML_NAMESPACES).text,
-            'failed_count': result.find('mt:numberTestErrors', self._XML_NAMESPACES).text,
-            'completed_count': result.find('mt:numberTestsCompleted', self._XML_NAMESPACES).text,
-            'errors': unit_test_errors
-        }
-
-        return state, state_detail, deployment_detail, unit_test_detail
+        return self._retrieve_deploy_result(async_process_id).to_status()
+
+    def deploy_and_wait(self, zipfile, options, stream=False, callback=None):
+        """ Deploys ZIP file and waits until deployment is finished
+            If callback is passed it is called with every event yielded by watch_deploy()
+            Returns the same 4-tuple as check_deploy_status() """
+        async_process_id, state = self.deploy(zipfile, options, stream)
+        for event in self.watch_deploy(async_process_id):
+            if callback is not None:
+                callback(event)
+            if event['event'] == 'done':
+                return event['status']
+
+    def watch_deploy(self, async_process_id):
+        """ Polls deployment without details and yields progress events until it is finished
+            Details are fetched only when number of component or test errors changes and once when deployment
+            is finished. Yields dicts with 'event' key set to 'progress' (state and counts changed),
+            'component_failure' / 'test_failure' (new failure) and 'done' (with 4-tuple status) """
+        delays = self._poller.delays()
+        progress = _DeployProgress()
+        while True:
+            events, has_details = progress.update(self._retrieve_deploy_result(async_process_id, False))
+            for event in events:
+                yield event
+            if has_details:
+                for event in progress.add_details(self._retrieve_deploy_result(async_process_id)):
+                    yield event
+            if progress.is_done:
+                return
+
+            delay = next(delays, None)
+            if delay is None:
+                raise self._poller.get_timeout_error()
+            time.sleep(delay)
 
     def download_unit_test_logs(self, async_process_id):
         """ Downloads Apex logs for unit tests executed during specified deployment """
-        result = self._retrieve_deploy_result(async_process_id)
+        result = parse_result(self._request_deploy_result(async_process_id, True).content, 'checkDeployStatusResponse')
         print("Results: %s" % ET.tostring(result, encoding="us-ascii", method="xml"))
 
     def retrieve(self, options):
         """ Submits retrieve request """
+        request = msg.RETRIEVE_MSG.format(**self._get_retrieve_attributes(self._session, options))
+        # Submit request
+        headers = {'Content-type': 'text/xml', 'SOAPAction': 'retrieve'}
+        res = self._session.post(self._get_api_url(), headers=headers, data=request)
+        if res.status_code != 200:
+            raise Exception(
+                "Request failed with %d code and error [%s]" %
+                (res.status_code, res.text))
+        # Parse results to get async Id and status
+        return parse_async_result(res.content, 'retrieveResponse')
+
+    @staticmethod
+    def _get_retrieve_attributes(session, options):
+        """ Composes retrieve request attributes """
         # Compose unpackaged XML
         unpackaged = ''
         for metadata_type in options['unpackaged']:
@@ -163,30 +187,13 @@ class SfdcMetadataApi:
                 unpackaged += '<members>{0}</members>'.format(member)
             unpackaged += '<name>{0}</name></types>'.format(metadata_type)
         # Compose retrieve request XML
-        attributes = {
+        return {
             'client': 'Metahelper',
-            'sessionId': self._session.get_session_id(),
-            'apiVersion': self._session.get_api_version(),
+            'sessionId': session.get_session_id(),
+            'apiVersion': session.get_api_version(),
             'singlePackage': options['single_package'],
             'unpackaged': unpackaged
         }
-        request = msg.RETRIEVE_MSG.format(**attributes)
-        # Submit request
-        headers = {'Content-type': 'text/xml', 'SOAPAction': 'retrieve'}
-        res = self._session.post(self._get_api_url(), headers=headers, data=request)
-        if res.status_code != 200:
-            raise Exception(
-                "Request failed with %d code and error [%s]" %
-                (res.status_code, res.text))
-        # Parse results to get async Id and status
-        async_process_id = ET.fromstring(res.text).find(
-            'soapenv:Body/mt:retrieveResponse/mt:result/mt:id',
-            self._XML_NAMESPACES).text
-        state = ET.fromstring(res.text).find(
-            'soapenv:Body/mt:retrieveResponse/mt:result/mt:state',
-            self._XML_NAMESPACES).text
-
-        return async_process_id, state
 
     def _retrieve_retrieve_result(self, async_process_id, include_zip):
         """ Retrieves status for specified retrieval id """
@@ -199,53 +206,763 @@ class SfdcMetadataApi:
         mt_request = msg.CHECK_RETRIEVE_STATUS_MSG.format(**attributes)
         headers = {'Content-type': 'text/xml', 'SOAPAction': 'checkRetrieveStatus'}
         res = self._session.post(self._get_api_url(), headers=headers, data=mt_request)
-        root = ET.fromstring(res.text)
-        result = root.find(
-            'soapenv:Body/mt:checkRetrieveStatusResponse/mt:result',
-            self._XML_NAMESPACES)
-        if result is None:
-            raise Exception("Result node could not be found: %s" % res.text)
+        return parse_retrieve_result(res.content)
+
+    def retrieve_zip_to(self, async_process_id, output):
+        """ Retrieves ZIP file and writes it to file name or binary file object
+            Response is parsed and decoded as it is downloaded so ZIP file is never held in memory
+            Returns the same 3-tuple as check_retrieve_status() """
+        attributes = {
+            'client': 'Metahelper',
+            'sessionId': self._session.get_session_id(),
+            'asyncProcessId': async_process_id,
+            'includeZip': 'true'
+        }
+        mt_request = msg.CHECK_RETRIEVE_STATUS_MSG.format(**attributes)
+        headers = {'Content-type': 'text/xml', 'SOAPAction': 'checkRetrieveStatus'}
+        res = self._session.post(self._get_api_url(), headers=headers, data=mt_request, stream=True)
+        try:
+            if res.status_code != 200:
+                raise Exception(
+                    "Request failed with %d code and error [%s]" %
+                    (res.status_code, res.text))
+            return self._write_retrieve_result(res.iter_content(_RetrieveResultParser.CHUNK_SIZE), output)
+        finally:
+            res.close()
 
-        return result
+    @staticmethod
+    def _write_retrieve_result(chunks, output):
+        """ Parses checkRetrieveStatus response read in chunks and writes decoded ZIP file to output
+            Returns the same 3-tuple as check_retrieve_status() """
+        if hasattr(output, 'write'):
+            file = output
+            should_close = False
+        else:
+            file = open(output, 'wb')
+            should_close = True
+        try:
+            parser = _RetrieveResultParser(file)
+            for chunk in chunks:
+                parser.feed(chunk)
+            return parser.close()
+        finally:
+            if should_close:
+                file.close()
 
     def retrieve_zip(self, async_process_id):
         """ Retrieves ZIP file """
         result = self._retrieve_retrieve_result(async_process_id, 'true')
-        state = result.find('mt:status', self._XML_NAMESPACES).text
-        error_message = result.find('mt:errorMessage', self._XML_NAMESPACES)
-        if error_message is not None:
-            error_message = error_message.text
-
-        # Check if there are any messages
-        messages = []
-        message_list = result.findall('mt:details/mt:messages', self._XML_NAMESPACES)
-        for message in message_list:
-            messages.append({
-                'file': message.find('mt:fileName', self._XML_NAMESPACES).text,
-                'message': message.find('mt:problem', self._XML_NAMESPACES).text
-            })
-
-        # Retrieve base64 encoded ZIP file
-        zipfile_base64 = result.find('mt:zipFile', self._XML_NAMESPACES).text
-        zipfile = b64decode(zipfile_base64)
-
-        return state, error_message, messages, zipfile
+        return result.to_status() + (result.get_zip(),)
 
     def check_retrieve_status(self, async_process_id):
         """ Checks whether retrieval succeeded """
-        result = self._retrieve_retrieve_result(async_process_id, 'false')
-        state = result.find('mt:status', self._XML_NAMESPACES).text
-        error_message = result.find('mt:errorMessage', self._XML_NAMESPACES)
-        if error_message is not None:
-            error_message = error_message.text
-
-        # Check if there are any messages
-        messages = []
-        message_list = result.findall('mt:details/mt:messages', self._XML_NAMESPACES)
-        for message in message_list:
-            messages.append({
-                'file': message.find('mt:fileName', self._XML_NAMESPACES).text,
-                'message': message.find('mt:problem', self._XML_NAMESPACES).text
-            })
-
-        return state, error_message, messages
+        return self._retrieve_retrieve_result(async_process_id, 'false').to_status()
+
+    def retrieve_and_wait(self, options, output=None):
+        """ Submits retrieve request and waits until it is finished
+            Returns the same 4-tuple as retrieve_zip(), ZIP file is None if retrieval failed
+            If output (file name or binary file object) is passed ZIP file is written to it
+            using retrieve_zip_to() and None is returned in place of ZIP file """
+        async_process_id, state = self.retrieve(options)
+        state, error_message, messages = self._poller.wait(
+            lambda: self.check_retrieve_status(async_process_id),
+            lambda status: status[0] in self._RETRIEVE_FINAL_STATES)
+        if state != 'Succeeded':
+            return state, error_message, messages, None
+        if output is not None:
+            return self.retrieve_zip_to(async_process_id, output) + (None,)
+        return self.retrieve_zip(async_process_id)
+
+    @staticmethod
+    def _partition_unpackaged(unpackaged, max_members, parent_types=None):
+        """ Splits types and members into groups having up to max_members members
+            Components stored in one file (object and its fields, ...) are kept in one group, types requested
+            with a wildcard are retrieved in groups of their own along with their parent and child types.
+            Profiles, permission sets and translations only contain settings of components retrieved
+            with them so they are added to every group """
+        parent_types = parent_types or {}
+        dependent = dict((metadata_type, list(members)) for metadata_type, members in unpackaged.items()
+                         if metadata_type in SfdcMetadataApi._DEPENDENT_TYPES)
+        others = [metadata_type for metadata_type in unpackaged if metadata_type not in dependent]
+        if not others:
+            others, dependent = list(unpackaged), {}
+
+        def get_root(metadata_type):
+            return parent_types.get(metadata_type, metadata_type)
+
+        # Whole family of types is kept together if it is requested with a wildcard or if names of
+        # child components do not tell their parent (e.g. CustomLabel)
+        whole_families = set()
+        for metadata_type in others:
+            members = unpackaged[metadata_type]
+            if '*' in members or (metadata_type in parent_types and any('.' not in member for member in members)):
+                whole_families.add(get_root(metadata_type))
+
+        units = OrderedDict()
+        for metadata_type in others:
+            root = get_root(metadata_type)
+            for member in unpackaged[metadata_type]:
+                if root in whole_families:
+                    key = (root, None)
+                elif metadata_type in parent_types:
+                    key = (root, member.split('.', 1)[0])
+                else:
+                    key = (root, member)
+                units.setdefault(key, OrderedDict()).setdefault(metadata_type, []).append(member)
+
+        groups = []
+        group = {}
+        size = 0
+        for key, unit in units.items():
+            unit_size = sum(len(members) for members in unit.values())
+            if any('*' in members for members in unit.values()):
+                groups.append(dict(unit))
+                continue
+            if group and size + unit_size > max_members:
+                groups.append(group)
+                group = {}
+                size = 0
+            for metadata_type, members in unit.items():
+                group.setdefault(metadata_type, []).extend(members)
+            size += unit_size
+        if group:
+            groups.append(group)
+        for group in groups:
+            for metadata_type, members in dependent.items():
+                group[metadata_type] = list(members)
+        return groups
+
+    @staticmethod
+    def _parse_package_xml(text):
+        """ Returns types and their members listed in package.xml """
+        types = {}
+        for metadata_type in ET.fromstring(text).findall('mt:types', SfdcMetadataApi._XML_NAMESPACES):
+            name = metadata_type.find('mt:name', SfdcMetadataApi._XML_NAMESPACES).text
+            types.setdefault(name, set()).update(
+                member.text for member in metadata_type.findall('mt:members', SfdcMetadataApi._XML_NAMESPACES))
+        return types
+
+    @staticmethod
+    def _compose_package_xml(types, version):
+        """ Composes package.xml listing passed types and their members """
+        lines = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<Package xmlns="{0}">'.format(SfdcMetadataApi._XML_NAMESPACES['mt'])]
+        for name in sorted(types):
+            lines.append('    <types>')
+            for member in sorted(types[name]):
+                lines.append('        <members>{0}</members>'.format(escape(member)))
+            lines.append('        <name>{0}</name>'.format(escape(name)))
+            lines.append('    </types>')
+        lines.append('    <version>{0}</version>'.format(version))
+        lines.append('</Package>')
+        return '\n'.join(lines) + '\n'
+
+    def _spool_retrieve_zip(self, async_process_id):
+        """ Retrieves ZIP file into a temporary file """
+        file = tempfile.TemporaryFile()
+        try:
+            result = self.retrieve_zip_to(async_process_id, file)
+        except Exception:
+            file.close()
+            raise
+        file.seek(0)
+        return result + (file,)
+
+    @staticmethod
+    def _get_output_path(output, filename):
+        """ Returns path of ZIP file entry extracted into output directory """
+        root = os.path.abspath(output)
+        path = os.path.abspath(os.path.join(root, *filename.split('/')))
+        if not path.startswith(root + os.sep):
+            raise Exception("ZIP file entry %s is outside of output directory" % filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+
+    @staticmethod
+    def _write_entry(archive, output, filename, data, date_time=None):
+        """ Writes ZIP file entry or file of output directory """
+        if archive is None:
+            with open(SfdcMetadataApi._get_output_path(output, filename), 'wb') as file:
+                file.write(data)
+            return
+        target = zip_archive.ZipInfo(filename, date_time or time.localtime()[:6])
+        target.compress_type = zip_archive.ZIP_DEFLATED
+        archive.writestr(target, data)
+
+    @staticmethod
+    def _merge_xml(contents):
+        """ Merges XML files of one profile, permission set or translation retrieved along with different
+            components. Child elements of the root are combined, elements present in several files are kept once
+            and new elements are put after the last element having the same name """
+        ET.register_namespace('', SfdcMetadataApi._XML_NAMESPACES['mt'])
+        root = ET.fromstring(contents[0])
+        seen = set(ET.tostring(element).strip() for element in root)
+        for content in contents[1:]:
+            for element in ET.fromstring(content):
+                key = ET.tostring(element).strip()
+                if key in seen:
+                    continue
+                seen.add(key)
+                index = len(root)
+                for i, existing in enumerate(root):
+                    if existing.tag == element.tag:
+                        index = i + 1
+                if index:
+                    # Keep indentation, the last element is followed by the closing tag's one
+                    element.tail, root[index - 1].tail = root[index - 1].tail, root.text
+                root.insert(index, element)
+        return b'<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(root)
+
+    def _merge_zips(self, files, output, as_directory):
+        """ Merges retrieved ZIP files into one archive or directory tree
+            package.xml files are merged and so are profiles, permission sets and translations retrieved
+            with different groups. Other files retrieved more than once must be identical """
+        packages = {}
+        merged = OrderedDict()
+        digests = {}
+        archive = None if as_directory else zip_archive.ZipFile(output, 'w', zip_archive.ZIP_DEFLATED)
+        try:
+            for file in files:
+                with zip_archive.ZipFile(file) as source:
+                    for info in source.infolist():
+                        if info.filename.endswith('/'):
+                            continue
+                        if os.path.basename(info.filename) == 'package.xml':
+                            for name, members in self._parse_package_xml(source.read(info)).items():
+                                packages.setdefault(info.filename, {}).setdefault(name, set()).update(members)
+                            continue
+                        if info.filename.endswith(self._MERGED_SUFFIXES):
+                            merged.setdefault(info.filename, []).append(source.read(info))
+                            continue
+                        data = source.read(info)
+                        digest = hashlib.sha1(data).hexdigest()
+                        if info.filename in digests:
+                            if digest != digests[info.filename]:
+                                raise Exception(
+                                    "Retrieved ZIP files contain different versions of %s" % info.filename)
+                            continue
+                        self._write_entry(archive, output, info.filename, data, info.date_time)
+                        digests[info.filename] = digest
+            for filename, contents in merged.items():
+                self._write_entry(
+                    archive, output, filename, contents[0] if len(contents) == 1 else self._merge_xml(contents))
+            for filename, types in packages.items():
+                self._write_entry(archive, output, filename,
+                                  self._compose_package_xml(types, self._session.get_api_version()).encode('utf-8'))
+        finally:
+            if archive is not None:
+                archive.close()
+
+    def retrieve_partitioned(self, options, output, max_members=5000, max_workers=4, as_directory=False, cache=None):
+        """ Retrieves metadata in several concurrent retrieve requests
+            Requested types and members are split into groups of up to max_members members, up to
+            max_workers retrieves are running at once and they are polled together. Resulting ZIP files
+            are merged into ZIP file written to output (file name or binary file object)
+            or extracted into output directory if as_directory is True. Parent and child types are
+            found using describe_metadata(), SfdcMetadataCache can be passed to cache its result
+            Returns 3-tuple containing state, error messages and warning/error messages """
+        groups = self._partition_unpackaged(
+            options['unpackaged'], max_members, self._get_parent_types(self.describe_metadata(cache)))
+        pending = list(enumerate(groups))
+        running = {}
+        results = {}
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        def retrieve(group):
+            return self.retrieve({'unpackaged': group, 'single_package': options['single_package']})[0]
+
+        def check():
+            """ Submits retrieves to free slots and polls running ones, returns True when all are done """
+            if pending and len(running) < max_workers:
+                started = pending[:max_workers - len(running)]
+                del pending[:len(started)]
+                running.update(zip(
+                    [index for index, group in started],
+                    executor.map(retrieve, [group for index, group in started])))
+            indexes = list(running)
+            for index, status in zip(indexes, executor.map(self.check_retrieve_status, [running[i] for i in indexes])):
+                if status[0] not in self._RETRIEVE_FINAL_STATES:
+                    continue
+                async_process_id = running.pop(index)
+                if status[0] == 'Succeeded':
+                    results[index] = executor.submit(self._spool_retrieve_zip, async_process_id)
+                else:
+                    results[index] = status + (None,)
+            return not pending and not running
+
+        try:
+            self._poller.wait(check, lambda is_done: is_done)
+            results = [results[index] for index in range(len(groups))]
+            results = [result.result() if hasattr(result, 'result') else result for result in results]
+        finally:
+            executor.shutdown(wait=True)
+
+        try:
+            files = [file for state, error_message, messages, file in results if file is not None]
+            self._merge_zips(files, output, as_directory)
+        finally:
+            for state, error_message, messages, file in results:
+                if file is not None:
+                    file.close()
+
+        states = [result[0] for result in results]
+        error_messages = [result[1] for result in results if result[1]]
+        return (
+            'Succeeded' if all(state == 'Succeeded' for state in states) else 'Failed',
+            '\n'.join(error_messages) if error_messages else None,
+            [message for result in results for message in result[2]])
+
+    def describe_metadata(self, cache=None, refresh=False):
+        """ Describes metadata types available in the org
+            If SfdcMetadataCache is passed its description is used unless refresh is True """
+        if cache is not None and not refresh and cache.get_describe() is not None:
+            return cache.get_describe()
+
+        attributes = {
+            'client': 'Metahelper',
+            'sessionId': self._session.get_session_id(),
+            'asOfVersion': self._session.get_api_version()
+        }
+        request = msg.DESCRIBE_METADATA_MSG.format(**attributes)
+        headers = {'Content-type': 'text/xml', 'SOAPAction': 'describeMetadata'}
+        res = self._session.post(self._get_api_url(), headers=headers, data=request)
+        if res.status_code != 200:
+            raise Exception(
+                "Request failed with %d code and error [%s]" %
+                (res.status_code, res.text))
+        describe = parse_describe_metadata(res.content)
+
+        if cache is not None:
+            cache.set_describe(describe)
+            cache.save()
+        return describe
+
+    def _list_metadata(self, queries):
+        """ Sends one listMetadata call with up to 3 queries """
+        queries_tag = ""
+        for query in queries:
+            queries_tag += "<met:queries>"
+            if query.get('folder'):
+                queries_tag += "<met:folder>%s</met:folder>" % escape(query['folder'])
+            queries_tag += "<met:type>%s</met:type></met:queries>\n" % escape(query['type'])
+        attributes = {
+            'client': 'Metahelper',
+            'sessionId': self._session.get_session_id(),
+            'queries': queries_tag,
+            'asOfVersion': self._session.get_api_version()
+        }
+        request = msg.LIST_METADATA_MSG.format(**attributes)
+        headers = {'Content-type': 'text/xml', 'SOAPAction': 'listMetadata'}
+        res = self._session.post(self._get_api_url(), headers=headers, data=request)
+        if res.status_code != 200:
+            raise Exception(
+                "Request failed with %d code and error [%s]" %
+                (res.status_code, res.text))
+
+        return parse_list_metadata(res.content)
+
+    def list_metadata(self, queries, max_workers=4):
+        """ Lists components of metadata types
+            Every query is either a type name or a dict with 'type' and optional 'folder' keys.
+            Queries are sent 3 per call and calls are made concurrently
+            Returns list of file properties with keys such as full_name, file_name, type and last_modified_date """
+        queries = [{'type': query} if not isinstance(query, dict) else query for query in queries]
+        groups = [queries[i:i + self._LIST_METADATA_QUERIES_PER_CALL]
+                  for i in range(0, len(queries), self._LIST_METADATA_QUERIES_PER_CALL)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return [component for components in executor.map(self._list_metadata, groups)
+                    for component in components]
+
+    def list_metadata_changes(self, queries, cache, max_workers=4):
+        """ Lists components of metadata types and compares them with SfdcMetadataCache by lastModifiedDate
+            All folders of a type must be queried at once. Cache is updated with listed components
+            Returns dict of added, changed and removed components """
+        queries = [{'type': query} if not isinstance(query, dict) else query for query in queries]
+        listed = dict((query['type'], []) for query in queries)
+        for component in self.list_metadata(queries, max_workers):
+            listed.setdefault(component['type'], []).append(component)
+
+        changes = {'added': [], 'changed': [], 'removed': []}
+        for metadata_type, components in listed.items():
+            for kind, diff in cache.diff_components(metadata_type, components).items():
+                changes[kind].extend(diff)
+            cache.set_components(metadata_type, components)
+        cache.save()
+        return changes
+
+    @staticmethod
+    def _get_parent_types(describe):
+        """ Maps child metadata types (CustomField, ValidationRule, ...) to their parent types """
+        return dict((child, metadata_object['xml_name'])
+                    for metadata_object in describe['metadata_objects']
+                    for child in metadata_object['child_xml_names'])
+
+    @staticmethod
+    def _get_parent_component(component, parent_types):
+        """ Returns type and name of the component whose file contains child component or None
+            Child components are listed with file of their parent, e.g. objects/Account.object """
+        parent_type = parent_types.get(component['type'])
+        if parent_type is None:
+            return None
+        parent_name = os.path.basename(component['file_name']).rsplit('.', 1)[0]
+        return parent_type, parent_name
+
+    @staticmethod
+    def _remove_component_files(working_dir, component):
+        """ Removes files of component from working tree """
+        root = os.path.abspath(working_dir)
+        path = os.path.abspath(os.path.join(root, *component['file_name'].split('/')))
+        if not path.startswith(root + os.sep):
+            return
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        for file_path in [path, path + '-meta.xml']:
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
+    def retrieve_delta(self, types, working_dir, max_members=5000, max_workers=4):
+        """ Retrieves components of specified types changed since the last call into working tree
+            Manifest of component names and lastModifiedDates is kept in working_dir. Added and changed
+            components are retrieved using retrieve_partitioned() and extracted over the working tree,
+            files of removed components are deleted and package.xml is regenerated. Child components
+            (fields, validation rules, ...) share the file of their parent so the parent is retrieved
+            whenever one of its children is added, changed or removed. Changed profiles, permission sets and
+            translations are retrieved with all listed components, their files cover the listed types only
+            Returns 4-tuple containing state, error message, warning/error messages
+            and dict of added, changed and removed components """
+        manifest = SfdcMetadataCache(working_dir, self._session)
+        parent_types = self._get_parent_types(self.describe_metadata(manifest))
+        queries = [{'type': query} if not isinstance(query, dict) else query for query in types]
+        listed = dict((query['type'], []) for query in queries)
+        for component in self.list_metadata(queries, max_workers):
+            listed.setdefault(component['type'], []).append(component)
+
+        changes = {'added': [], 'changed': [], 'removed': []}
+        for metadata_type, components in listed.items():
+            for kind, diff in manifest.diff_components(metadata_type, components).items():
+                changes[kind].extend(diff)
+
+        removed = set((component['type'], component['full_name']) for component in changes['removed'])
+        unpackaged = {}
+        for component in changes['added'] + changes['changed'] + changes['removed']:
+            parent = self._get_parent_component(component, parent_types)
+            if parent is None:
+                if (component['type'], component['full_name']) not in removed:
+                    unpackaged.setdefault(component['type'], set()).add(component['full_name'])
+            elif parent not in removed:
+                unpackaged.setdefault(parent[0], set()).add(parent[1])
+        # Profiles, permission sets and translations only contain entries of components retrieved with them,
+        # so they are retrieved together with every listed component to keep their files complete
+        if any(metadata_type in self._DEPENDENT_TYPES for metadata_type in unpackaged):
+            for components in listed.values():
+                for component in components:
+                    if component['type'] not in self._DEPENDENT_TYPES:
+                        unpackaged.setdefault(component['type'], set()).add(component['full_name'])
+        unpackaged = dict((metadata_type, sorted(members)) for metadata_type, members in unpackaged.items())
+
+        state, error_message, messages = 'Succeeded', None, []
+        if unpackaged:
+            state, error_message, messages = self.retrieve_partitioned(
+                {'unpackaged': unpackaged, 'single_package': 'true'}, working_dir,
+                max_members=max_members, max_workers=max_workers, as_directory=True, cache=manifest)
+        if state != 'Succeeded':
+            return state, error_message, messages, changes
+
+        # Files still used by other components (e.g. object of a removed field) are kept
+        used_files = set(component['file_name'] for components in listed.values() for component in components)
+        for component in changes['removed']:
+            if component['file_name'] not in used_files and \
+                    self._get_parent_component(component, parent_types) is None:
+                self._remove_component_files(working_dir, component)
+
+        for metadata_type, components in listed.items():
+            manifest.set_components(metadata_type, components)
+        manifest.save()
+
+        # Package.xml of the working tree lists all components, not only retrieved ones
+        package_types = {}
+        for metadata_type in manifest.get_types():
+            members = list(manifest.get_components(metadata_type))
+            if members:
+                package_types[metadata_type] = members
+        with open(os.path.join(working_dir, 'package.xml'), 'w') as package_file:
+            package_file.write(self._compose_package_xml(package_types, self._session.get_api_version()))
+
+        return state, error_message, messages, changes
+
+    @staticmethod
+    def _get_component_files(source_dir, describe):
+        """ Maps files of metadata API format source tree to components using describeMetadata result
+            Returns dict of file paths (relative, '/' separated) keyed by (type, full name) """
+        directories = dict((metadata_object['directory_name'], metadata_object)
+                           for metadata_object in describe['metadata_objects'])
+        components = {}
+        for root, dir_names, file_names in os.walk(source_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                path = os.path.relpath(os.path.join(root, file_name), source_dir).replace(os.sep, '/')
+                parts = path.split('/')
+                metadata_object = directories.get(parts[0])
+                if metadata_object is None or len(parts) < 2:
+                    continue
+                if metadata_object['suffix'] is None and not metadata_object['in_folder'] and len(parts) > 2:
+                    # Bundle (aura, lwc, ...) is deployed as a whole
+                    full_name = parts[1]
+                else:
+                    full_name = '/'.join(parts[1:])
+                if full_name.endswith('-meta.xml'):
+                    full_name = full_name[:-len('-meta.xml')]
+                if metadata_object['suffix'] is not None and full_name.endswith('.' + metadata_object['suffix']):
+                    full_name = full_name[:-len(metadata_object['suffix']) - 1]
+                components.setdefault((metadata_object['xml_name'], full_name), []).append(path)
+        return components
+
+    @staticmethod
+    def _hash_component(source_dir, paths):
+        """ Returns content hash of component's files """
+        digest = hashlib.sha1()
+        for path in sorted(paths):
+            digest.update(path.encode('utf-8') + b'\0')
+            with open(os.path.join(source_dir, *path.split('/')), 'rb') as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def deploy_delta(self, source_dir, options, cache, stream=False):
+        """ Deploys only components of metadata API format source tree changed since the last successful deploy
+            Content hashes of deployed components are kept in SfdcMetadataCache, files are mapped
+            to components using describe_metadata(). ZIP file contains changed components,
+            generated package.xml and destructiveChanges.xml listing removed components
+            Returns the same 4-tuple as check_deploy_status() or None if there is nothing to deploy """
+        components = self._get_component_files(source_dir, self.describe_metadata(cache))
+        hashes = {}
+        for (metadata_type, full_name), paths in components.items():
+            hashes.setdefault(metadata_type, {})[full_name] = self._hash_component(source_dir, paths)
+
+        deployed = cache.get_deployed()
+        changed = {}
+        removed = {}
+        for metadata_type, members in hashes.items():
+            for full_name, digest in members.items():
+                if deployed.get(metadata_type, {}).get(full_name) != digest:
+                    changed.setdefault(metadata_type, []).append(full_name)
+        for metadata_type, members in deployed.items():
+            for full_name in members:
+                if full_name not in hashes.get(metadata_type, {}):
+                    removed.setdefault(metadata_type, []).append(full_name)
+        if not changed and not removed:
+            return None
+
+        version = self._session.get_api_version()
+        with tempfile.TemporaryFile() as file:
+            with zip_archive.ZipFile(file, 'w', zip_archive.ZIP_DEFLATED) as archive:
+                for metadata_type, members in changed.items():
+                    for full_name in members:
+                        for path in components[(metadata_type, full_name)]:
+                            archive.write(os.path.join(source_dir, *path.split('/')), path)
+                archive.writestr('package.xml', self._compose_package_xml(changed, version))
+                if removed:
+                    archive.writestr('destructiveChanges.xml', self._compose_package_xml(removed, version))
+            file.seek(0)
+            status = self.deploy_and_wait(file, options, stream)
+
+        if status[0] == 'Succeeded' and str(options.get('checkonly', 'false')).lower() != 'true':
+            cache.set_deployed(hashes)
+            cache.save()
+        return status
+
+
+class _DeployRequestBody:
+    """ File-like deploy request body which base64 encodes ZIP file in chunks as it is read
+        Only one chunk of ZIP file is held in memory at a time """
+    _CHUNK_SIZE = 3 * 256 * 1024
+
+    def __init__(self, prefix, zipfile, suffix):
+        if hasattr(zipfile, 'read'):
+            self._file = zipfile
+            self._should_close = False
+        else:
+            self._file = open(zipfile, 'rb')
+            self._should_close = True
+        self._file.seek(0, 2)
+        zip_size = self._file.tell()
+        self._file.seek(0)
+        self._prefix = prefix.encode('utf-8')
+        self._suffix = suffix.encode('utf-8')
+        self._length = len(self._prefix) + (zip_size + 2) // 3 * 4 + len(self._suffix)
+        self._buffer = self._prefix
+        self._offset = 0
+        self._is_zip_read = False
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        chunk = self.read(self._CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = self.read(self._CHUNK_SIZE)
+
+    def _fill_buffer(self):
+        """ Appends next part of request to buffer, returns False when nothing is left """
+        if self._is_zip_read:
+            return False
+        raw = self._file.read(self._CHUNK_SIZE)
+        if raw:
+            part = b64encode(raw)
+        else:
+            self._is_zip_read = True
+            part = self._suffix
+            if self._should_close:
+                self._file.close()
+        self._buffer = self._buffer[self._offset:] + part
+        self._offset = 0
+        return True
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self._buffer) - self._offset < size) and self._fill_buffer():
+            pass
+        if size is None or size < 0:
+            size = len(self._buffer) - self._offset
+        chunk = self._buffer[self._offset:self._offset + size]
+        self._offset += len(chunk)
+        return chunk
+
+    def close(self):
+        if self._should_close and not self._file.closed:
+            self._file.close()
+
+
+class _DeployProgress:
+    """ Turns results of deployment polled without details into events of watch_deploy()
+        Tells when details should be fetched and reports every failure found in them once """
+
+    def __init__(self):
+        self._progress = None
+        self._errors = (0, 0)
+        self._failures = {'component_failure': [], 'test_failure': []}
+        self.is_done = False
+
+    def update(self, result):
+        """ Returns progress events of result polled without details and whether details should be fetched """
+        current = {
+            'event': 'progress',
+            'state': result.state,
+            'state_detail': result.state_detail,
+            'components_total': int(result.components_total),
+            'components_deployed': int(result.components_deployed),
+            'component_errors': int(result.component_errors),
+            'tests_total': int(result.tests_total),
+            'tests_completed': int(result.tests_completed),
+            'test_errors': int(result.test_errors)
+        }
+        if current == self._progress:
+            return [], False
+        self._progress = current
+        if result.state in SfdcMetadataApi._DEPLOY_FINAL_STATES:
+            self.is_done = True
+            return [current], True
+        errors = (current['component_errors'], current['test_errors'])
+        has_new_errors = errors != self._errors
+        self._errors = errors
+        return [current], has_new_errors
+
+    def add_details(self, result):
+        """ Returns failure events of result fetched with details not reported yet
+            followed by done event if deployment is finished """
+        events = []
+        for event, errors in [('component_failure', result.component_failures),
+                              ('test_failure', result.test_failures)]:
+            for error in errors:
+                if error not in self._failures[event]:
+                    self._failures[event].append(error)
+                    failure = {'event': event}
+                    failure.update(error)
+                    events.append(failure)
+        if self.is_done:
+            events.append({'event': 'done', 'status': result.to_status()})
+        return events
+
+
+class _RetrieveResultParser:
+    """ Incremental parser of checkRetrieveStatus response
+        Base64 encoded ZIP file is decoded and written to output as its text arrives """
+    CHUNK_SIZE = 256 * 1024
+    _SOAP_ENV = SfdcMetadataApi._XML_NAMESPACES['soapenv']
+    _MT = SfdcMetadataApi._XML_NAMESPACES['mt']
+
+    def __init__(self, output):
+        self._output = output
+        self._parser = expat.ParserCreate(namespace_separator=' ')
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+        self._path = []
+        self._text = []
+        self._pending = b''
+        self._is_found = False
+        self._fault = None
+        self._state = None
+        self._error_message = None
+        self._messages = []
+        self._message = None
+
+    def _in_result(self, *names):
+        """ Returns True if current element is checkRetrieveStatusResponse/result/<names> """
+        return len(self._path) == len(names) + 4 and self._path[2:] == [
+            (self._MT, 'checkRetrieveStatusResponse'), (self._MT, 'result')] + [(self._MT, name) for name in names]
+
+    def _start(self, name, attributes):
+        self._path.append(tuple(name.split(' ', 1)) if ' ' in name else ('', name))
+        self._text = []
+        if self._in_result():
+            self._is_found = True
+        elif self._in_result('details', 'messages'):
+            self._message = {'file': None, 'message': None}
+
+    def _end(self, name):
+        text = ''.join(self._text)
+        if self._in_result('status'):
+            self._state = text
+        elif self._in_result('errorMessage'):
+            self._error_message = text
+        elif self._in_result('zipFile'):
+            self._write(b'', True)
+        elif self._in_result('details', 'messages', 'fileName'):
+            self._message['file'] = text
+        elif self._in_result('details', 'messages', 'problem'):
+            self._message['message'] = text
+        elif self._in_result('details', 'messages'):
+            self._messages.append(self._message)
+        elif self._path[-1][1] == 'faultstring':
+            self._fault = text
+        self._path.pop()
+        self._text = []
+
+    def _data(self, data):
+        if self._in_result('zipFile'):
+            self._write(data.encode('ascii'))
+        else:
+            self._text.append(data)
+
+    def _write(self, data, is_final=False):
+        """ Decodes complete base64 quads and writes them to output """
+        self._pending += b''.join(data.split())
+        size = len(self._pending) if is_final else len(self._pending) // 4 * 4
+        if size:
+            self._output.write(b64decode(self._pending[:size]))
+            self._pending = self._pending[size:]
+
+    def feed(self, chunk):
+        self._parser.Parse(chunk, False)
+
+    def close(self):
+        """ Finishes parsing, returns state, error message and messages """
+        self._parser.Parse(b'', True)
+        if not self._is_found:
+            raise Exception("Result node could not be found: %s" % self._fault)
+        return self._state, self._error_message, self._messages
@@ -0,0 +1,314 @@
+""" Parsers of Salesforce SOAP and Bulk API XML responses
+    Every response is parsed once and children are matched against fully qualified tag names,
+    results are mapped into lightweight objects """
+import re
+from base64 import b64decode
+from xml.etree import ElementTree as ET
+
+_SOAPENV = '{http://schemas.xmlsoap.org/soap/envelope/}'
+_METADATA = '{http://soap.sforce.com/2006/04/metadata}'
+_ENTERPRISE = '{urn:enterprise.soap.sforce.com}'
+_ASYNCAPI = '{http://www.force.com/2009/06/asyncapi/dataload}'
+
+_BODY = _SOAPENV + 'Body'
+_FAULT = _SOAPENV + 'Fault'
+
+
+def _qualify(namespace, names):
+    """ Maps fully qualified tag names to attribute names """
+    return dict((namespace + tag, name) for tag, name in names.items())
+
+
+def _read_fields(element, fields, target):
+    """ Sets attributes of target from text of element's children listed in fields
+        Returns children which are not listed """
+    rest = []
+    for child in element:
+        name = fields.get(child.tag)
+        if name is None:
+            rest.append(child)
+        else:
+            setattr(target, name, child.text)
+    return rest
+
+
+def parse_result(text, response_name):
+    """ Returns result node of Metadata API response """
+    body = ET.fromstring(text).find(_BODY)
+    result = None
+    if body is not None:
+        result = body.find("{0}{1}/{0}result".format(_METADATA, response_name))
+    if result is None:
+        raise Exception("Result node could not be found: %s" % text)
+    return result
+
+
+def parse_async_result(text, response_name):
+    """ Returns async process id and state from deploy or retrieve response """
+    result = parse_result(text, response_name)
+    return result.findtext(_METADATA + 'id'), result.findtext(_METADATA + 'state')
+
+
+def parse_deploy_result(text):
+    """ Parses checkDeployStatus response into DeployResult """
+    return DeployResult.from_element(parse_result(text, 'checkDeployStatusResponse'))
+
+
+def parse_retrieve_result(text):
+    """ Parses checkRetrieveStatus response into RetrieveResult """
+    return RetrieveResult.from_element(parse_result(text, 'checkRetrieveStatusResponse'))
+
+
+def parse_batch_info(text):
+    """ Parses batch info returned when batch is added """
+    return BatchInfo.from_element(ET.fromstring(text))
+
+
+def parse_batch_info_list(text):
+    """ Parses list of job's batches """
+    return [BatchInfo.from_element(batch) for batch in ET.fromstring(text).iterfind(_ASYNCAPI + 'batchInfo')]
+
+
+def parse_result_list(text):
+    """ Parses list of batch's result ids """
+    return [result.text for result in ET.fromstring(text).iterfind(_ASYNCAPI + 'result')]
+
+
+def _to_snake_case(name):
+    return re.sub('([A-Z])', r'_\1', name).lower()
+
+
+_METADATA_OBJECTS = _METADATA + 'metadataObjects'
+_METADATA_OBJECT_FIELDS = _qualify(_METADATA, {
+    'xmlName': 'xml_name',
+    'directoryName': 'directory_name',
+    'suffix': 'suffix',
+    'inFolder': 'in_folder',
+    'metaFile': 'meta_file',
+    'childXmlNames': 'child_xml_names'
+})
+_DESCRIBE_FIELDS = _qualify(_METADATA, {
+    'organizationNamespace': 'organization_namespace',
+    'partialSaveAllowed': 'partial_save_allowed',
+    'testRequired': 'test_required'
+})
+_BOOLEAN_FIELDS = frozenset(['in_folder', 'meta_file', 'partial_save_allowed', 'test_required'])
+
+
+def _read_field(element, fields, target):
+    """ Stores text of element in target under name mapped by fields, booleans are converted and
+        child_xml_names are collected into a list """
+    name = fields.get(element.tag)
+    if name == 'child_xml_names':
+        target[name].append(element.text)
+    elif name in _BOOLEAN_FIELDS:
+        target[name] = element.text == 'true'
+    elif name is not None:
+        target[name] = element.text
+
+
+def parse_describe_metadata(text):
+    """ Parses describeMetadata response into dict of metadata types and organization settings """
+    describe = {
+        'metadata_objects': [],
+        'organization_namespace': None,
+        'partial_save_allowed': False,
+        'test_required': False
+    }
+    for child in parse_result(text, 'describeMetadataResponse'):
+        if child.tag != _METADATA_OBJECTS:
+            _read_field(child, _DESCRIBE_FIELDS, describe)
+            continue
+        metadata_object = {
+            'xml_name': None,
+            'directory_name': None,
+            'suffix': None,
+            'in_folder': False,
+            'meta_file': False,
+            'child_xml_names': []
+        }
+        for field in child:
+            _read_field(field, _METADATA_OBJECT_FIELDS, metadata_object)
+        describe['metadata_objects'].append(metadata_object)
+    return describe
+
+
+def parse_list_metadata(text):
+    """ Parses listMetadata response into list of file properties with snake case keys """
+    body = ET.fromstring(text).find(_BODY)
+    if body is None:
+        return []
+    return [dict((_to_snake_case(node.tag[len(_METADATA):]), node.text) for node in result)
+            for result in body.iterfind("{0}listMetadataResponse/{0}result".format(_METADATA))]
+
+
+def parse_login_response(text):
+    """ Returns session id, server URL and organization id from login response """
+    body = ET.fromstring(text).find(_BODY)
+    fault = body.find(_FAULT)
+    if fault is not None:
+        raise Exception("Could not log in. Code: %s Message: %s" % (
+            fault.findtext('faultcode'), fault.findtext('faultstring')))
+    result = body.find("{0}loginResponse/{0}result".format(_ENTERPRISE))
+    return (result.findtext(_ENTERPRISE + 'sessionId'),
+            result.findtext(_ENTERPRISE + 'serverUrl'),
+            result.findtext("{0}userInfo/{0}organizationId".format(_ENTERPRISE)))
+
+
+class DeployResult:
+    """ Result of checkDeployStatus call
+        Counts are kept as strings the way they are returned by Salesforce """
+    __slots__ = ('id', 'state', 'state_detail', 'components_total', 'component_errors', 'components_deployed',
+                 'tests_total', 'test_errors', 'tests_completed', 'component_failures', 'test_failures')
+
+    _FIELDS = _qualify(_METADATA, {
+        'id': 'id',
+        'status': 'state',
+        'stateDetail': 'state_detail',
+        'numberComponentsTotal': 'components_total',
+        'numberComponentErrors': 'component_errors',
+        'numberComponentsDeployed': 'components_deployed',
+        'numberTestsTotal': 'tests_total',
+        'numberTestErrors': 'test_errors',
+        'numberTestsCompleted': 'tests_completed'
+    })
+    _DETAILS = _METADATA + 'details'
+    _COMPONENT_FAILURES = _METADATA + 'componentFailures'
+    _TEST_FAILURES_PATH = "{0}runTestResult/{0}failures".format(_METADATA)
+    _COMPONENT_FAILURE_FIELDS = _qualify(_METADATA, {
+        'componentType': 'type',
+        'fileName': 'file',
+        'problemType': 'status',
+        'problem': 'message'
+    })
+    _TEST_FAILURE_FIELDS = _qualify(_METADATA, {
+        'name': 'class',
+        'methodName': 'method',
+        'message': 'message',
+        'stackTrace': 'stack_trace'
+    })
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.component_failures = []
+        self.test_failures = []
+
+    @staticmethod
+    def _read_failure(element, fields):
+        failure = dict.fromkeys(fields.values())
+        for child in element:
+            name = fields.get(child.tag)
+            if name is not None:
+                failure[name] = child.text
+        return failure
+
+    @classmethod
+    def from_element(cls, element):
+        result = cls()
+        for child in _read_fields(element, cls._FIELDS, result):
+            if child.tag != cls._DETAILS:
+                continue
+            # Component and test successes can be numerous, only failures are read
+            for failure in child.iterfind(cls._COMPONENT_FAILURES):
+                result.component_failures.append(cls._read_failure(failure, cls._COMPONENT_FAILURE_FIELDS))
+            for failure in child.iterfind(cls._TEST_FAILURES_PATH):
+                result.test_failures.append(cls._read_failure(failure, cls._TEST_FAILURE_FIELDS))
+        return result
+
+    def to_status(self):
+        """ Returns 4-tuple containing state, state detail, deployment detail and unit test detail
+            Errors are included only if deployment failed """
+        is_failed = self.state == 'Failed'
+        deployment_detail = {
+            'total_count': self.components_total,
+            'failed_count': self.component_errors,
+            'deployed_count': self.components_deployed,
+            'errors': self.component_failures if is_failed else []
+        }
+        unit_test_detail = {
+            'total_count': self.tests_total,
+            'failed_count': self.test_errors,
+            'completed_count': self.tests_completed,
+            'errors': self.test_failures if is_failed else []
+        }
+        return self.state, self.state_detail, deployment_detail, unit_test_detail
+
+
+class RetrieveResult:
+    """ Result of checkRetrieveStatus call, ZIP file is kept base64 encoded """
+    __slots__ = ('id', 'state', 'error_message', 'messages', 'zip_file')
+
+    _FIELDS = _qualify(_METADATA, {
+        'id': 'id',
+        'status': 'state',
+        'errorMessage': 'error_message',
+        'zipFile': 'zip_file'
+    })
+    _DETAILS = _METADATA + 'details'
+    _MESSAGES = _METADATA + 'messages'
+    _FILE_NAME = _METADATA + 'fileName'
+    _PROBLEM = _METADATA + 'problem'
+
+    def __init__(self):
+        self.id = None
+        self.state = None
+        self.error_message = None
+        self.messages = []
+        self.zip_file = None
+
+    @classmethod
+    def from_element(cls, element):
+        result = cls()
+        for child in _read_fields(element, cls._FIELDS, result):
+            if child.tag == cls._DETAILS:
+                for message in child.iterfind(cls._MESSAGES):
+                    result.messages.append({
+                        'file': message.findtext(cls._FILE_NAME),
+                        'message': message.findtext(cls._PROBLEM)
+                    })
+        return result
+
+    def get_zip(self):
+        """ Returns decoded ZIP file or None if it was not included """
+        return b64decode(self.zip_file) if self.zip_file is not None else None
+
+    def to_status(self):
+        """ Returns 3-tuple containing state, error message and warning/error messages """
+        return self.state, self.error_message, self.messages
+
+
+class BatchInfo:
+    """ Bulk API batch information
+        Supports item access (batch['state']) so it can be used in place of a dict """
+    __slots__ = ('id', 'job_id', 'state', 'message', 'processed', 'failed')
+
+    _FIELDS = _qualify(_ASYNCAPI, {
+        'id': 'id',
+        'jobId': 'job_id',
+        'state': 'state',
+        'stateMessage': 'message',
+        'numberRecordsProcessed': 'processed',
+        'numberRecordsFailed': 'failed'
+    })
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    @classmethod
+    def from_element(cls, element):
+        result = cls()
+        _read_fields(element, cls._FIELDS, result)
+        return result
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return "BatchInfo(%r)" % self.to_dict()
@@ -0,0 +1,59 @@
+""" Class to poll Salesforce asynchronous operations """
+import random
+import time
+
+
+class SfdcPoller:
+    """ Polls asynchronous operation until it is done
+        Interval between polls starts at initial_interval and grows exponentially up to max_interval,
+        every interval is randomized by +/- jitter fraction of its length """
+
+    def __init__(self, initial_interval=0.5, backoff=1.5, max_interval=30.0, jitter=0.1, timeout=None):
+        self._initial_interval = initial_interval
+        self._backoff = backoff
+        self._max_interval = max_interval
+        self._jitter = jitter
+        self._timeout = timeout
+
+    def get_timeout(self):
+        return self._timeout
+
+    def intervals(self):
+        """ Yields intervals between polls """
+        interval = self._initial_interval
+        while True:
+            yield max(0, interval * (1 + random.uniform(-self._jitter, self._jitter)))
+            interval = min(interval * self._backoff, self._max_interval)
+
+    def delays(self):
+        """ Returns iterator of intervals between polls which stops once timeout elapses
+            Timeout is counted from this call and the last interval is shortened to end at the deadline """
+        deadline = None if self._timeout is None else time.time() + self._timeout
+
+        def delays():
+            for interval in self.intervals():
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    interval = min(interval, remaining)
+                yield interval
+
+        return delays()
+
+    def get_timeout_error(self):
+        """ Returns exception raised when operation does not complete within timeout """
+        return Exception("Operation did not complete within %s seconds" % self._timeout)
+
+    def wait(self, func, is_done):
+        """ Calls func until is_done returns True for its result, returns last result
+            Raises an exception if operation does not complete within timeout """
+        delays = self.delays()
+        result = func()
+        while not is_done(result):
+            delay = next(delays, None)
+            if delay is None:
+                raise self.get_timeout_error()
+            time.sleep(delay)
+            result = func()
+        return result
@@ -1,5 +1,7 @@
 """ Class to work with Salesforce REST API """
+import itertools
 import json
+from concurrent.futures import ThreadPoolExecutor
 try:
     from urllib.parse import urlencode
 except ImportError:
@@ -10,6 +12,15 @@ class SfdcRestApi:
     """ Class to work with Salesforce REST API """
     _API_BASE_URI = "/services/data/v{version}"
     _SOQL_QUERY_URI = "/query/?{query}"
+    _SOQL_QUERY_ALL_URI = "/queryAll/?{query}"
+    _COMPOSITE_URI = "/composite"
+    _COMPOSITE_BATCH_URI = "/composite/batch"
+    _COMPOSITE_TREE_URI = "/composite/tree/{object}"
+    _SOBJECT_COLLECTIONS_URI = "/composite/sobjects"
+    _MAX_COLLECTION_SIZE = 200
+    _MAX_COMPOSITE_SIZE = 25
+    _COLLECTIONS_MIN_VERSION = 42.0
+    _COMPOSITE_MIN_VERSION = 38.0
 
     def __init__(self, session):
         if not session.is_connected():
@@ -46,6 +57,12 @@ class SfdcRestApi:
         response = self._session.post(url, headers=self._get_headers(), json=data)
         return self._parse_get_post_response(response)
 
+    def patch(self, uri, data):
+        """ HTTP PATCH request """
+        url = self._session.construct_url(self._get_api_uri() + uri)
+        response = self._session.patch(url, headers=self._get_headers(), json=data)
+        return self._parse_get_post_response(response)
+
     def delete(self, uri):
         """ HTTP DELETE request """
         try:
@@ -56,9 +73,237 @@ class SfdcRestApi:
         except ValueError:
             raise Exception("Request failed, response is not JSON: %s" % response.text)
 
-    def soql_query(self, query):
-        """ SOQL query """
+    def soql_query(self, query, cache_ttl=None):
+        """ SOQL query
+            Result is taken from session's query cache if it has one, cache_ttl overrides cache's ttl """
+        cache = self._session.get_query_cache()
+        if cache is not None:
+            return cache.fetch(self._session, 'rest', query, lambda: self._soql_query(query), cache_ttl)
+        return self._soql_query(query)
+
+    def _soql_query(self, query):
         res = self.get(self._SOQL_QUERY_URI.format(**{'query': urlencode({'q': query})}))
         if not isinstance(res, dict):
             raise Exception("Request failed. Response: %s" % res)
         return res
+
+    def _get_next_records(self, next_records_url):
+        """ Fetches next page of query results """
+        url = self._session.construct_url(next_records_url)
+        res = self._parse_get_post_response(self._session.get(url, headers=self._get_headers()))
+        if not isinstance(res, dict):
+            raise Exception("Request failed. Response: %s" % res)
+        return res
+
+    def _iter_query(self, uri, query, prefetch):
+        """ Yields records of all pages of query results
+            If prefetch is True next page is fetched in background while current one is consumed """
+        res = self.get(uri.format(**{'query': urlencode({'q': query})}))
+        if not isinstance(res, dict):
+            raise Exception("Request failed. Response: %s" % res)
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            while True:
+                next_records_url = res.get('nextRecordsUrl')
+                next_page = None
+                if next_records_url and executor is not None:
+                    next_page = executor.submit(self._get_next_records, next_records_url)
+                for record in res['records']:
+                    yield record
+                if not next_records_url:
+                    return
+                res = next_page.result() if next_page is not None else self._get_next_records(next_records_url)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def query_iter(self, query, prefetch=True):
+        """ Lazily yields records of SOQL query following nextRecordsUrl """
+        return self._iter_query(self._SOQL_QUERY_URI, query, prefetch)
+
+    def query_all_iter(self, query, prefetch=True):
+        """ Lazily yields records of SOQL query including deleted and archived ones """
+        return self._iter_query(self._SOQL_QUERY_ALL_URI, query, prefetch)
+
+    @staticmethod
+    def _split(items, size):
+        """ Splits iterable into lists of up to size items """
+        group = []
+        for item in items:
+            group.append(item)
+            if len(group) == size:
+                yield group
+                group = []
+        if group:
+            yield group
+
+    @staticmethod
+    def _check_api_version(session, resource, min_version):
+        """ Raises an exception if session's API version is older than the resource """
+        if float(session.get_api_version()) < min_version:
+            raise Exception("%s requires API version %.1f or later, session uses %s" % (
+                resource, min_version, session.get_api_version()))
+
+    @staticmethod
+    def _split_all_or_none(items, size, all_or_none):
+        """ Splits items into lists of up to size items
+            Groups are committed independently so all or none request must fit into one of them """
+        groups = SfdcRestApi._split(items, size)
+        if not all_or_none:
+            return groups
+        groups = list(itertools.islice(groups, 2))
+        if len(groups) > 1:
+            raise Exception("Request with all_or_none can not take more than %d items" % size)
+        return groups
+
+    @staticmethod
+    def _check_composite(session, subrequests):
+        """ Returns subrequests as list, raises an exception if they can not be split into independent groups """
+        SfdcRestApi._check_api_version(session, "Composite", SfdcRestApi._COMPOSITE_MIN_VERSION)
+        subrequests = list(subrequests)
+        if len(subrequests) > SfdcRestApi._MAX_COMPOSITE_SIZE and \
+                any('@{' in json.dumps(subrequest) for subrequest in subrequests):
+            raise Exception("Composite request using references can not take more than %d subrequests"
+                            % SfdcRestApi._MAX_COMPOSITE_SIZE)
+        return subrequests
+
+    @staticmethod
+    def _add_attributes(records, object_name):
+        """ Adds type attribute to records which do not have attributes """
+        return [record if 'attributes' in record else dict(record, attributes={'type': object_name})
+                for record in records]
+
+    @staticmethod
+    def _add_tree_attributes(records, object_name):
+        """ Adds type attribute and generated reference Id to root records which do not have attributes """
+        return [record if 'attributes' in record else
+                dict(record, attributes={'type': object_name, 'referenceId': 'ref{0}'.format(index)})
+                for index, record in enumerate(records)]
+
+    @staticmethod
+    def _get_delete_query(ids, all_or_none):
+        return urlencode({'ids': ','.join(ids), 'allOrNone': 'true' if all_or_none else 'false'})
+
+    @staticmethod
+    def _dispatch(func, groups, max_workers):
+        """ Calls func for every group concurrently, returns concatenated results in groups' order
+            At most max_workers groups are held in memory and sent at once """
+        results = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = []
+            for group in groups:
+                if len(pending) >= max_workers:
+                    results.extend(pending.pop(0).result())
+                pending.append(executor.submit(func, group))
+            for future in pending:
+                results.extend(future.result())
+        return results
+
+    def _post_collection(self, method, uri, object_name, records, all_or_none, max_workers):
+        """ Sends records to sObject Collections resource in groups of 200 """
+        self._check_api_version(self._session, "sObject Collections", self._COLLECTIONS_MIN_VERSION)
+
+        def send(group):
+            res = method(uri, {'allOrNone': all_or_none, 'records': self._add_attributes(group, object_name)})
+            if not isinstance(res, list):
+                raise Exception("Request failed. Response: %s" % res)
+            return res
+
+        return self._dispatch(
+            send, self._split_all_or_none(records, self._MAX_COLLECTION_SIZE, all_or_none), max_workers)
+
+    def create_records(self, object_name, records, all_or_none=False, max_workers=4):
+        """ Creates records using sObject Collections, returns per-record results in input order """
+        return self._post_collection(
+            self.post, self._SOBJECT_COLLECTIONS_URI, object_name, records, all_or_none, max_workers)
+
+    def update_records(self, object_name, records, all_or_none=False, max_workers=4):
+        """ Updates records using sObject Collections
+            Records will be matched by Id field """
+        return self._post_collection(
+            self.patch, self._SOBJECT_COLLECTIONS_URI, object_name, records, all_or_none, max_workers)
+
+    def upsert_records(self, object_name, external_id_field, records, all_or_none=False, max_workers=4):
+        """ Upserts records using sObject Collections
+            Records will be matched by external id field """
+        uri = "{0}/{1}/{2}".format(self._SOBJECT_COLLECTIONS_URI, object_name, external_id_field)
+        return self._post_collection(self.patch, uri, object_name, records, all_or_none, max_workers)
+
+    def delete_records(self, ids, all_or_none=False, max_workers=4):
+        """ Deletes records using sObject Collections """
+        self._check_api_version(self._session, "sObject Collections", self._COLLECTIONS_MIN_VERSION)
+
+        def send(group):
+            url = self._session.construct_url(
+                self._get_api_uri() + self._SOBJECT_COLLECTIONS_URI + "?" + self._get_delete_query(group, all_or_none))
+            res = self._parse_get_post_response(self._session.delete(url, headers=self._get_headers()))
+            if not isinstance(res, list):
+                raise Exception("Request failed. Response: %s" % res)
+            return res
+
+        return self._dispatch(
+            send, self._split_all_or_none(ids, self._MAX_COLLECTION_SIZE, all_or_none), max_workers)
+
+    def composite(self, subrequests, all_or_none=False, max_workers=4):
+        """ Executes subrequests using Composite resource in groups of 25
+            Groups are independent and run concurrently, so more than 25 subrequests are only accepted
+            if they do not use references (@{...}) and all_or_none is False """
+        subrequests = self._check_composite(self._session, subrequests)
+
+        def send(group):
+            res = self.post(self._COMPOSITE_URI, {'allOrNone': all_or_none, 'compositeRequest': group})
+            if not isinstance(res, dict):
+                raise Exception("Request failed. Response: %s" % res)
+            return res['compositeResponse']
+
+        return self._dispatch(
+            send, self._split_all_or_none(subrequests, self._MAX_COMPOSITE_SIZE, all_or_none), max_workers)
+
+    def composite_batch(self, subrequests, halt_on_error=False, max_workers=4):
+        """ Executes independent subrequests using Composite Batch resource in groups of 25
+            halt_on_error only stops remaining subrequests of the same group """
+        def send(group):
+            res = self.post(self._COMPOSITE_BATCH_URI, {'haltOnError': halt_on_error, 'batchRequests': group})
+            if not isinstance(res, dict):
+                raise Exception("Request failed. Response: %s" % res)
+            return res['results']
+
+        return self._dispatch(send, self._split(subrequests, self._MAX_COMPOSITE_SIZE), max_workers)
+
+    @staticmethod
+    def _count_tree(record):
+        """ Returns number of records in a record tree """
+        count = 1
+        for value in record.values():
+            if isinstance(value, dict) and isinstance(value.get('records'), list):
+                count += sum(SfdcRestApi._count_tree(child) for child in value['records'])
+        return count
+
+    @staticmethod
+    def _split_trees(records, size):
+        """ Splits record trees into lists having up to size records in total """
+        group = []
+        group_size = 0
+        for record in records:
+            count = SfdcRestApi._count_tree(record)
+            if group and group_size + count > size:
+                yield group
+                group = []
+                group_size = 0
+            group.append(record)
+            group_size += count
+        if group:
+            yield group
+
+    def composite_tree(self, object_name, records, max_workers=4):
+        """ Creates record trees using sObject Tree resource in groups of up to 200 records
+            Root records without attributes get type and generated reference Id """
+        def send(group):
+            res = self.post(self._COMPOSITE_TREE_URI.format(**{'object': object_name}),
+                            {'records': self._add_tree_attributes(group, object_name)})
+            if not isinstance(res, dict):
+                raise Exception("Request failed. Response: %s" % res)
+            return res['results']
+
+        return self._dispatch(send, self._split_trees(records, self._MAX_COLLECTION_SIZE), max_workers)
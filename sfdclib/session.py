@@ -1,7 +1,14 @@
 import re
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
 
 from requests import Session
-from xml.etree import ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from sfdclib.parsers import parse_login_response
 
 
 class SfdcSession(Session):
@@ -13,6 +20,11 @@ class SfdcSession(Session):
         'mt': 'http://soap.sforce.com/2006/04/metadata',
         'd': 'urn:enterprise.soap.sforce.com'
     }
+    _EXPIRED_SESSION_STATUSES = [400, 401, 500]
+    _EXPIRED_SESSION_CODES = [b'INVALID_SESSION_ID', b'InvalidSessionId']
+    _REQUEST_LIMIT_CODE = b'REQUEST_LIMIT_EXCEEDED'
+    _UNAVAILABLE_STATUS = 503
+    _UNAVAILABLE_BACKOFF = 1.0
 
     _LOGIN_TMPL = \
         """<env:Envelope xmlns:xsd='http://www.w3.org/2001/XMLSchema'
@@ -38,25 +50,190 @@ xmlns:env='http://schemas.xmlsoap.org/soap/envelope/'>
         self._api_version = api_version
         self._session_id = kwargs.get("session_id", None)
         self._instance = kwargs.get("instance", None)
+        self._instance_url = kwargs.get("instance_url", None)
+        self._org_id = kwargs.get("org_id", None)
+        self._token_cache = kwargs.get("token_cache", None)
+        self._query_cache = kwargs.get("query_cache", None)
+        self._login_lock = threading.Lock()
+        self._login_state = threading.local()
+        self._timeout = kwargs.get("timeout", None)
+        self._limit_retries = kwargs.get("limit_retries", 3)
+        retries = kwargs.get("max_retries", None)
+        if retries is None:
+            retries = self._get_default_retry()
+        adapter = HTTPAdapter(
+            pool_connections=kwargs.get("pool_connections", 10),
+            pool_maxsize=kwargs.get("pool_maxsize", 10),
+            pool_block=kwargs.get("pool_block", False),
+            max_retries=retries)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    @staticmethod
+    def _get_default_retry():
+        """ Returns retry policy repeating requests which could not connect
+            Requests rejected with 503 are repeated by _send() which knows whether the body can be sent again """
+        options = {
+            'total': 3,
+            'connect': 3,
+            'read': False,
+            'status': 0,
+            'respect_retry_after_header': False,
+            'backoff_factor': 1,
+            'raise_on_status': False
+        }
+        try:
+            return Retry(allowed_methods=None, **options)
+        except TypeError:
+            # urllib3 older than 1.26
+            return Retry(method_whitelist=False, **options)
+
+    def login(self, refresh=False):
+        """ Logs in, valid session id found in token cache is reused unless refresh is True """
+        if self._token_cache is not None and not refresh:
+            token = self._token_cache.get(self._get_token_key())
+            if token is not None:
+                self._session_id, self._instance, self._org_id = \
+                    token['session_id'], token['instance'], token['org_id']
+                return
 
-    def login(self):
         url = self.construct_url(self.get_soap_api_uri())
         headers = {'Content-Type': 'text/xml', 'SOAPAction': 'login'}
-        password = self._password
-        if self._token:
-            password += self._token
-        data = SfdcSession._LOGIN_TMPL.format(**{'username': self._username, 'password': password})
-        r = self.post(url, headers=headers, data=data)
-        root = ET.fromstring(r.text)
-        if root.find('soapenv:Body/soapenv:Fault', SfdcSession._XML_NAMESPACES):
-            raise Exception("Could not log in. Code: %s Message: %s" % (
-                root.find('soapenv:Body/soapenv:Fault/faultcode', SfdcSession._XML_NAMESPACES).text,
-                root.find('soapenv:Body/soapenv:Fault/faultstring', SfdcSession._XML_NAMESPACES).text))
-        self._session_id = root.find('soapenv:Body/d:loginResponse/d:result/d:sessionId', SfdcSession._XML_NAMESPACES).text
-        server_url = root.find('soapenv:Body/d:loginResponse/d:result/d:serverUrl', SfdcSession._XML_NAMESPACES).text
-        self._instance = re.search("""https://(.*).salesforce.com/.*""", server_url).group(1)
+        data = self._get_login_request(self._username, self._password, self._token)
+        self._login_state.is_logging_in = True
+        try:
+            r = self.post(url, headers=headers, data=data)
+        finally:
+            self._login_state.is_logging_in = False
+        self._session_id, self._instance, self._org_id = self._parse_login_response(r.text)
+
+        if self._token_cache is not None:
+            self._token_cache.set(self._get_token_key(), {
+                'session_id': self._session_id,
+                'instance': self._instance,
+                'org_id': self._org_id,
+                'created': time.time()
+            })
+
+    def _get_token_key(self):
+        """ Returns key of the session in token cache """
+        return "{0}@{1}".format(
+            self._username, self._instance_url or ('test' if self._is_sandbox else 'login'))
+
+    def _can_login(self):
+        return self._username is not None and self._password is not None
+
+    @staticmethod
+    def _is_session_expired(status_code, content):
+        """ Checks whether response reports invalid or expired session id """
+        return status_code in SfdcSession._EXPIRED_SESSION_STATUSES and \
+            any(code in content for code in SfdcSession._EXPIRED_SESSION_CODES)
+
+    @staticmethod
+    def _replace_session_id(kwargs, old_session_id, new_session_id):
+        """ Returns request arguments with old session id replaced in headers and body
+            Returns None if request can not be repeated because its body was streamed """
+        if not SfdcSession._is_repeatable(kwargs):
+            return None
+        kwargs = dict(kwargs)
+        if kwargs.get('headers'):
+            kwargs['headers'] = dict(
+                (name, value.replace(old_session_id, new_session_id) if isinstance(value, str) else value)
+                for name, value in kwargs['headers'].items())
+        data = kwargs.get('data')
+        if isinstance(data, str):
+            kwargs['data'] = data.replace(old_session_id, new_session_id)
+        elif isinstance(data, bytes):
+            kwargs['data'] = data.replace(old_session_id.encode('utf-8'), new_session_id.encode('utf-8'))
+        return kwargs
+
+    @staticmethod
+    def _is_repeatable(kwargs):
+        """ Checks whether request body can be sent again """
+        data = kwargs.get('data')
+        return data is None or isinstance(data, (str, bytes, dict, list, tuple))
+
+    @staticmethod
+    def _get_retry_after(res):
+        """ Returns number of seconds to wait according to Retry-After header or None if it is missing """
+        value = res.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _get_retry_delay(self, res, attempt):
+        """ Returns number of seconds to wait before repeating rejected request or None if it is not repeated
+            Service unavailable responses are repeated with exponential backoff unless Retry-After is given,
+            request limit responses only when Retry-After tells when to retry """
+        if res.status_code == self._UNAVAILABLE_STATUS:
+            delay = self._get_retry_after(res)
+            return delay if delay is not None else self._UNAVAILABLE_BACKOFF * 2 ** attempt
+        if res.status_code == 403 and self._REQUEST_LIMIT_CODE in res.content:
+            return self._get_retry_after(res)
+        return None
+
+    def _send(self, method, url, *args, **kwargs):
+        """ Sends request, repeats it when service is unavailable or request limit is exceeded
+            Requests with streamed body are never repeated """
+        if self._timeout is not None:
+            kwargs.setdefault('timeout', self._timeout)
+        attempt = 0
+        while True:
+            res = super(SfdcSession, self).request(method, url, *args, **kwargs)
+            if res.status_code not in (403, self._UNAVAILABLE_STATUS) or attempt >= self._limit_retries or \
+                    not self._is_repeatable(kwargs):
+                return res
+            delay = self._get_retry_delay(res, attempt)
+            if delay is None:
+                return res
+            res.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def request(self, method, url, *args, **kwargs):
+        """ Sends request, if session expired logs in again and repeats the request once """
+        session_id = self._session_id
+        res = self._send(method, url, *args, **kwargs)
+        # Body of successful responses is not touched so they can be streamed
+        if res.status_code not in self._EXPIRED_SESSION_STATUSES or session_id is None or \
+                getattr(self._login_state, 'is_logging_in', False) or not self._can_login() or \
+                not self._is_session_expired(res.status_code, res.content):
+            return res
+
+        with self._login_lock:
+            # Other thread may have logged in already
+            if self._session_id == session_id:
+                self.login(refresh=True)
+        retry = self._replace_session_id(kwargs, session_id, self._session_id)
+        if retry is None:
+            return res
+        res.close()
+        return self._send(method, url, *args, **retry)
+
+    @staticmethod
+    def _get_login_request(username, password, token):
+        """ Composes login request """
+        if token:
+            password += token
+        return SfdcSession._LOGIN_TMPL.format(**{'username': username, 'password': password})
+
+    @staticmethod
+    def _parse_login_response(text):
+        """ Returns session id, instance name and organization id from login response """
+        session_id, server_url, org_id = parse_login_response(text)
+        instance = re.search("""https://(.*).salesforce.com/.*""", server_url)
+        return session_id, instance.group(1) if instance else None, org_id
 
     def get_server_url(self):
+        if self._instance_url:
+            return self._instance_url
         if not self._instance:
             return SfdcSession._LOGIN_URL.format(**{'instance': 'test' if self._is_sandbox else 'login'})
         return SfdcSession._LOGIN_URL.format(**{'instance': self._instance})
@@ -73,5 +250,11 @@ xmlns:env='http://schemas.xmlsoap.org/soap/envelope/'>
     def get_session_id(self):
         return self._session_id
 
+    def get_org_id(self):
+        return self._org_id
+
+    def get_query_cache(self):
+        return self._query_cache
+
     def is_connected(self):
-        return True if self._instance else False
+        return True if self._instance or self._instance_url and self._session_id else False
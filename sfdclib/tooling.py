@@ -14,6 +14,8 @@ class SfdcToolingApi():
     _EXECUTE_ANON_APEX_URI = "/executeAnonymous/?{a}"
     _TRACE_FLAG_URI = "/sobjects/traceFlag"
     _APEX_LOG_URI = "/sobjects/ApexLog/{uid}/Body"
+    _COMPOSITE_URI = "/composite"
+    _DOWNLOAD_CHUNK_SIZE = 1024 * 1024
     
     def __init__(self, session):
         if not session.is_connected():
@@ -70,13 +72,43 @@ class SfdcToolingApi():
         except ValueError:
             raise Exception("Request failed, response is not JSON: %s" % response.text)
 
-    def anon_query(self, query):
-        ''' Anonymous query '''
+    def get_api_path(self, uri):
+        ''' Returns path of Tooling API resource as used by subrequests of composite request '''
+        return self._get_tooling_api_uri() + uri
+
+    def composite(self, subrequests, all_or_none=False):
+        ''' Executes up to 25 subrequests in one Composite request, returns list of subrequest responses '''
+        res = self.post(self._COMPOSITE_URI, json.dumps({'allOrNone': all_or_none, 'compositeRequest': subrequests}))
+        if not isinstance(res, dict):
+            raise Exception("Request failed. Response: %s" % res)
+        return res['compositeResponse']
+
+    def anon_query(self, query, cache_ttl=None):
+        ''' Anonymous query
+            Result is taken from session's query cache if it has one, cache_ttl overrides cache's ttl '''
+        cache = self._session.get_query_cache()
+        if cache is not None:
+            return cache.fetch(self._session, 'tooling', query, lambda: self._anon_query(query), cache_ttl)
+        return self._anon_query(query)
+
+    def _anon_query(self, query):
         res = self.get(self._ANON_QUERY_URI.format(**{'query': urlencode({'q': query})}))
         if not isinstance(res, dict):
             raise Exception("Request failed. Response: %s" % res)
         return res
 
+    def anon_query_all(self, query):
+        ''' Anonymous query returning records of all result pages '''
+        res = self.anon_query(query, cache_ttl=0)
+        records = list(res.get('records') or [])
+        prefix = self._get_tooling_api_uri()
+        while res.get('nextRecordsUrl'):
+            res = self.get(res['nextRecordsUrl'][len(prefix):])
+            if not isinstance(res, dict):
+                raise Exception("Request failed. Response: %s" % res)
+            records.extend(res.get('records') or [])
+        return records
+
     def getDebug(self, uri):
         ''' HTTP GET request '''
         url = self._session.construct_url(self._get_tooling_api_uri() + uri)
@@ -95,6 +127,31 @@ class SfdcToolingApi():
         res = self.get_textBody(self._APEX_LOG_URI.format(**{'uid': id}))
         return res
 
+    def download_apex_log(self, log_id, output):
+        ''' Streams ApexLog body to file name or binary file object, returns number of bytes written '''
+        url = self._session.construct_url(self._get_tooling_api_uri() + self._APEX_LOG_URI.format(**{'uid': log_id}))
+        response = self._session.get(url, headers=self._get_headers(), stream=True)
+        try:
+            if response.status_code != 200:
+                raise Exception("Request failed with %d code and error [%s]" % (response.status_code, response.text))
+            if hasattr(output, 'write'):
+                file = output
+                should_close = False
+            else:
+                file = open(output, 'wb')
+                should_close = True
+            try:
+                size = 0
+                for chunk in response.iter_content(self._DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+                    size += len(chunk)
+                return size
+            finally:
+                if should_close:
+                    file.close()
+        finally:
+            response.close()
+
     def set_Traceflag(self,tfid):
         # check if there is an existing traceflag
         userId = self.get_sf_user_id(self._session._username)
@@ -102,7 +159,7 @@ class SfdcToolingApi():
         tfCheckQ = "SELECT Id FROM TraceFlag WHERE TracedEntityId = '{}'".format(userId)
 
 
-        tfCheck = self.anon_query(tfCheckQ)
+        tfCheck = self.anon_query(tfCheckQ, cache_ttl=0)
         json_string = json.dumps(tfCheck)
         parsedJSON = json.loads(json_string)
         
@@ -157,7 +214,7 @@ class SfdcToolingApi():
         # get auditlog id
         logQuery = "SELECT Id FROM ApexLog WHERE LogUserId = '{}' ORDER BY SystemModstamp DESC NULLS LAST LIMIT 1".format(userId)
 
-        logQRes = self.anon_query(logQuery)
+        logQRes = self.anon_query(logQuery, cache_ttl=0)
         AuditLogId = self.parse_JSON_Response(logQRes)
         queryResponse = self.apexLog_Q(AuditLogId)
         # remove the traceflag